@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import platform
+import subprocess
+import multiprocessing
+import numpy as np
+import metrosampler
+import metrosampler.sampler as samp
+import metrosampler.hitandrun as hitr
+import metrosampler.posterior as post
+import metrosampler.diagnostics as diag
+import metrosampler.constraints as cons
+
+DATA_DIR = os.path.join(os.path.dirname(metrosampler.__file__), 'examples',
+                        'Data')
+CONSTRAINED = ('alloy', 'mixture', 'polytope')
+
+
+class CorrelatedGaussian(post.Distribution):
+    """Zero mean Gaussian distribution with a given precision matrix."""
+
+    def __init__(self, precision):
+        self.ndim = precision.shape[0]
+        self.precision = precision
+
+    def get_example(self):
+        return np.zeros(self.ndim)
+
+    def prob(self, x):
+        return np.exp(self.log_prob(x))
+
+    def log_prob(self, x):
+        return -0.5 * np.dot(x, np.dot(self.precision, x))
+
+
+def write_polytope(fname, ndim):
+    """
+    Write a constraints file for a box with bounds on the sum of the
+    coordinates, in the format of the alloy specifications.
+    """
+    lower, upper = 0.1 / ndim, 1.5 / ndim
+    terms = ' + '.join('x[%d]' % i for i in range(ndim))
+
+    with open(fname, 'w') as f:
+        f.write('%d\n' % ndim)
+        f.write(' '.join(['%r' % (0.8 / ndim)] * ndim) + '\n')
+        f.write('# Synthetic polytope\n')
+        f.write('1.0 - %s >= 0.0\n' % terms)
+        f.write('%s - 0.5 >= 0.0\n' % terms)
+        for i in range(ndim):
+            f.write('x[%d] - %r >= 0.0\n' % (i, lower))
+            f.write('%r - x[%d] >= 0.0\n' % (upper, i))
+
+
+def make_workload(name, ndim, workdir):
+    """Return the distribution and initial proposal covariance of a case."""
+    if name == 'alloy' or name == 'mixture':
+        constraints = cons.Constraint(os.path.join(DATA_DIR, name + '.txt'))
+        posterior = post.ConstrainedDistribution(constraints)
+        ndim = constraints.get_ndim()
+        return posterior, 1.0e-6 * np.identity(ndim)
+
+    if name == 'polytope':
+        fname = os.path.join(workdir, 'polytope_%d.txt' % ndim)
+        write_polytope(fname, ndim)
+        constraints = cons.Constraint(fname)
+        posterior = post.ConstrainedDistribution(constraints)
+        return posterior, (0.1 / ndim) ** 2 * np.identity(ndim)
+
+    if name == 'gaussian2d':
+        # The distribution of the two-dimensional Gaussian example
+        precision = np.array([[0.5, -0.2], [-0.2, 0.5]])
+        return CorrelatedGaussian(precision), np.identity(2)
+
+    # Strongly correlated Gaussian with a tridiagonal precision matrix
+    precision = 2.0 * np.identity(ndim)
+    precision += np.diag(-0.9 * np.ones(ndim - 1), 1)
+    precision += np.diag(-0.9 * np.ones(ndim - 1), -1)
+    return CorrelatedGaussian(precision), np.identity(ndim)
+
+
+def run_case(args):
+    """
+    Run a benchmark case and return its measurements.
+
+    Executed in a fresh worker process so that peak memory is measured for
+    the case alone.
+    """
+    name, ndim, method, steps, workdir, seed = args
+    np.random.seed(seed)
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.time()
+    posterior, covariance = make_workload(name, ndim, workdir)
+    load_time = time.time() - start
+
+    # Density evaluations on states around the example
+    x0 = posterior.get_example()
+    states = x0 + 1.0e-3 * np.random.standard_normal((1000, x0.shape[0]))
+    start = time.time()
+    for state in states:
+        posterior.log_prob(state)
+    prob_rate = states.shape[0] / (time.time() - start)
+
+    start = time.time()
+    posterior.log_prob_batch(states)
+    prob_batch_rate = states.shape[0] / (time.time() - start)
+
+    # Burnin and adaptation, then the timed run
+    if method == 'hitandrun':
+        sampler = hitr.HitAndRunSampler(posterior, x0, steps // 2)
+    else:
+        sampler = samp.MetroSampler(posterior, x0, covariance, 200, 1000,
+                                    steps // 2, 0.1)
+    start = time.time()
+    chain, accepted, total = sampler.sample(steps, 1)
+    elapsed = time.time() - start
+
+    ess = steps / np.max(diag.integrated_time(chain))
+    rss_end = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return dict(workload=name, ndim=x0.shape[0], sampler=method, steps=steps,
+                load_time=load_time, prob_per_sec=prob_rate,
+                prob_batch_per_sec=prob_batch_rate,
+                steps_per_sec=total / elapsed, ess=ess,
+                ess_per_sec=ess / elapsed,
+                acceptance=float(accepted) / float(total),
+                peak_rss_kb=rss_end, rss_increase_kb=rss_end - rss_start)
+
+
+def git_revision():
+    """Return the current git commit, or None outside a git checkout."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(__file__)).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+
+    # Arguments descriptions
+    descA = 'Benchmark the sampler on the reference workloads'
+    descO = 'path to the JSON file where the results will be saved'
+    descD = 'dimensions of the synthetic polytopes and Gaussians'
+    descS = 'number of timed steps of each case'
+    descW = 'workloads to run'
+    descM = 'samplers to run; hit-and-run only runs on constrained workloads'
+
+    parser = argparse.ArgumentParser(description=descA)
+    parser.add_argument('--output', help=descO, default='benchmarks.json')
+    parser.add_argument('--dims', help=descD, type=int, nargs='+',
+                        default=[2, 10, 100, 1000])
+    parser.add_argument('--steps', help=descS, type=int, default=5000)
+    parser.add_argument('--workloads', help=descW, nargs='+',
+                        default=['alloy', 'mixture', 'gaussian2d', 'polytope',
+                                 'gaussian'])
+    parser.add_argument('--samplers', help=descM, nargs='+',
+                        default=['metropolis', 'hitandrun'],
+                        choices=['metropolis', 'hitandrun'])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    cases = []
+    for name in args.workloads:
+        dims = args.dims if name in ('polytope', 'gaussian') else [None]
+        for method in args.samplers:
+            if method == 'hitandrun' and name not in CONSTRAINED:
+                continue
+            cases.extend((name, ndim, method) for ndim in dims)
+
+    results = []
+    try:
+        for i, (name, ndim, method) in enumerate(cases):
+            # A new process per case keeps the memory measurements apart
+            pool = multiprocessing.Pool(1, maxtasksperchild=1)
+            try:
+                result = pool.apply(run_case, ((name, ndim, method, args.steps,
+                                                workdir, i),))
+            finally:
+                pool.close()
+                pool.join()
+
+            results.append(result)
+            print '%-10s %5d %-10s %10.1f steps/s %10.2f ESS/s %10d KB' % \
+                  (result['workload'], result['ndim'], result['sampler'],
+                   result['steps_per_sec'], result['ess_per_sec'],
+                   result['peak_rss_kb'])
+    finally:
+        shutil.rmtree(workdir)
+
+    report = dict(revision=git_revision(), time=time.time(),
+                  python=platform.python_version(), numpy=np.__version__,
+                  steps=args.steps, results=results)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
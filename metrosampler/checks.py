@@ -23,6 +23,21 @@ def check_vector_size(x_vector, size):
         raise ValueError('Error: input vector size is not valid')
 
 
+def check_batch_validity(x_batch):
+    """Raise an assertion if x_batch is not a NumPy matrix of row vectors."""
+    if not isinstance(x_batch, np.ndarray):
+        raise ValueError('Error: input is not a NumPy ndarray')
+
+    if len(x_batch.shape) != 2:
+        raise ValueError('Error: input is not a batch of vectors')
+
+
+def check_batch_size(x_batch, size):
+    """Raise an assertion if the vectors in x_batch have size other than size."""
+    if x_batch.shape[1] != size:
+        raise ValueError('Error: input vectors size is not valid')
+
+
 def check_matrix_validity(x_matrix):
     """Raise an assertion is x_matrix is not a symmetric NumPy matrix."""
     if not isinstance(x_matrix, np.ndarray):
@@ -1,27 +1,394 @@
+import os
+import ast
+import sys
+import hashlib
+import numbers
+import threading
+import numpy as np
+import scipy.optimize
+
+# Version of the analysis and layout of the cached models, part of the
+# cache keys
+CACHE_VERSION = 2
+
+# Attributes of the analyzed model stored in the cache
+_CACHED = ('n_dim', 'example', 'linear_sources', 'expr_sources',
+           'coefficients', 'offsets', 'lower', 'upper', 'lower_index',
+           'upper_index', 'row_index')
+
+
+def _linear_form(node, n_dim):
+    """
+    Decompose an expression into a linear function of the state vector.
+
+    :param node: the expression to decompose (ast node)
+    :param n_dim: the dimension of the state vector (int)
+    :return: the coefficients (numpy.ndarray) and the constant term (float)
+        of the expression, or None if the expression is not linear in x
+    """
+    if isinstance(node, ast.Num):
+        if not isinstance(node.n, numbers.Real):
+            return None
+        return np.zeros(n_dim), float(node.n)
+
+    if isinstance(node, ast.Subscript):
+        # Only x[i] with a constant, in-range index is a linear term
+        if not isinstance(node.value, ast.Name) or node.value.id != 'x':
+            return None
+        if not isinstance(node.slice, ast.Index):
+            return None
+
+        index = node.slice.value
+        if not isinstance(index, ast.Num) or \
+                not isinstance(index.n, numbers.Integral):
+            return None
+        if index.n < 0 or index.n >= n_dim:
+            return None
+
+        coefficients = np.zeros(n_dim)
+        coefficients[index.n] = 1.0
+        return coefficients, 0.0
+
+    if isinstance(node, ast.UnaryOp):
+        operand = _linear_form(node.operand, n_dim)
+        if operand is None:
+            return None
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        if isinstance(node.op, ast.USub):
+            return -operand[0], -operand[1]
+        return None
+
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Sub)):
+        # Walk long sums iteratively, they are nested as deep as they are long
+        terms = []
+        while isinstance(node, ast.BinOp) and \
+                isinstance(node.op, (ast.Add, ast.Sub)):
+            terms.append((node.right, isinstance(node.op, ast.Sub)))
+            node = node.left
+        terms.append((node, False))
+
+        coefficients, constant = np.zeros(n_dim), 0.0
+        for term, negative in reversed(terms):
+            linear = _linear_form(term, n_dim)
+            if linear is None:
+                return None
+            if negative:
+                coefficients -= linear[0]
+                constant -= linear[1]
+            else:
+                coefficients += linear[0]
+                constant += linear[1]
+        return coefficients, constant
+
+    if isinstance(node, ast.BinOp):
+        left = _linear_form(node.left, n_dim)
+        right = _linear_form(node.right, n_dim)
+        if left is None or right is None:
+            return None
+
+        # Products and quotients are linear only if one factor is constant
+        if isinstance(node.op, ast.Mult):
+            if not np.any(left[0]):
+                return left[1] * right[0], left[1] * right[1]
+            if not np.any(right[0]):
+                return right[1] * left[0], right[1] * left[1]
+        if isinstance(node.op, ast.Div):
+            # Integers are divided with integer division by the expressions,
+            # such quotients are left to them
+            if _integer_constant(node.left) and _integer_constant(node.right):
+                return None
+            if not np.any(right[0]) and right[1] != 0.0:
+                return left[0] / right[1], left[1] / right[1]
+        return None
+
+    return None
+
+
+def _integer_constant(node):
+    """Return True if an expression only combines integer literals."""
+    for child in ast.walk(node):
+        if isinstance(child, ast.Num):
+            if not isinstance(child.n, numbers.Integral):
+                return False
+        elif not isinstance(child, (ast.BinOp, ast.UnaryOp, ast.operator,
+                                    ast.unaryop)):
+            return False
+    return True
+
+
+def _linear_constraint(line, n_dim):
+    """
+    Convert a constraint into the form a . x >= b if it is linear.
+
+    :param line: the constraint to convert (string)
+    :param n_dim: the dimension of the state vector (int)
+    :return: the coefficients a (numpy.ndarray) and the offset b (float),
+        or None if the constraint is not a linear inequality
+    """
+    try:
+        node = ast.parse(line.strip(), mode='eval').body
+    except SyntaxError:
+        return None
+
+    # Only non-strict inequalities between two expressions are supported
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1:
+        return None
+
+    left = _linear_form(node.left, n_dim)
+    right = _linear_form(node.comparators[0], n_dim)
+    if left is None or right is None:
+        return None
+
+    if isinstance(node.ops[0], ast.GtE):
+        return left[0] - right[0], right[1] - left[1]
+    if isinstance(node.ops[0], ast.LtE):
+        return right[0] - left[0], left[1] - right[1]
+    return None
+
+
 class Constraint():
     """Constraints loaded from a file."""
 
-    def __init__(self, fname):
+    def __init__(self, fname, presolve=True, reorder_every=1000,
+                 cache_dir=None):
         """
         Construct a Constraint object from a constraints file
 
+        Linear inequalities are collected into a matrix model A . x >= b that
+        is checked with a single matrix-vector product; all other constraints
+        are compiled and evaluated one by one. The presolve moves linear
+        constraints on a single variable to per-variable bounds and drops the
+        linear constraints that are implied by the others.
+
+        The nonlinear constraints are evaluated in an order learnt while the
+        constraints are applied: every reorder_every evaluations they are
+        sorted by how often they reject, so that a rejected vector is
+        usually discarded by the first expression evaluated.
+
         :param fname: Name of the file to read the Constraint from (string)
+        :param presolve: whether to presolve the linear constraints (bool)
+        :param reorder_every: number of evaluations between reorderings of
+            the nonlinear constraints, 0 to keep the file order (int)
+        :param cache_dir: directory where the analyzed model is cached,
+            keyed by the content of the file, None to disable the cache
+            (string)
         """
         with open(fname, "r") as f:
-            lines = f.readlines()
+            content = f.read()
+
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = self._cache_file(cache_dir, content, presolve)
+        if cache_file is None or not self._load_model(cache_file):
+            self._analyze(content.splitlines(True), presolve)
+            if cache_file is not None:
+                self._save_model(cache_file)
+        self.exprs = [compile(source, "<string>", "eval")
+                      for source in self.expr_sources]
+
+        # Evaluation order of the nonlinear constraints and the statistics
+        # it is learnt from
+        self.reorder_every = reorder_every
+        self.expr_evals = np.zeros(len(self.exprs))
+        self.expr_hits = np.zeros(len(self.exprs))
+        self.set_order(range(len(self.exprs)))
+
+        # Rejection counts, only collected when tracking is enabled
+        self.linear_rejections = None
+        self.expr_rejections = None
+
+        # Serializes the updates of the statistics above when the
+        # constraints are applied on several threads
+        self.lock = threading.Lock()
+        return
+
+    def _analyze(self, lines, presolve):
+        """
+        Build the model of the constraints from the lines of a file
+
+        :param lines: the lines of the file (list of string)
+        :param presolve: whether to presolve the linear constraints (bool)
+        """
         # Parse the dimension from the first line
         self.n_dim = int(lines[0])
         # Parse the example from the second line
         self.example = [float(x) for x in lines[1].split(" ")[0:self.n_dim]]
 
-        # Run through the rest of the lines and compile the constraints
-        self.exprs = []
+        # Run through the rest of the lines and sort the constraints
+        self.expr_sources = []
+        self.linear_sources = []
+        coefficients = []
+        offsets = []
         for i in range(2, len(lines)):
             # support comments in the first line
             if lines[i][0] == "#":
                 continue
-            self.exprs.append(compile(lines[i], "<string>", "eval"))
-        return
+
+            linear = _linear_constraint(lines[i], self.n_dim)
+            if linear is not None:
+                coefficients.append(linear[0])
+                offsets.append(linear[1])
+                self.linear_sources.append(lines[i])
+                continue
+            self.expr_sources.append(lines[i])
+
+        self.coefficients = np.array(coefficients).reshape(-1, self.n_dim)
+        self.offsets = np.array(offsets, dtype=float)
+
+        # Bounds on each variable and the linear source each row comes from
+        self.lower = -np.inf * np.ones(self.n_dim)
+        self.upper = np.inf * np.ones(self.n_dim)
+        self.lower_index = -np.ones(self.n_dim, dtype=int)
+        self.upper_index = -np.ones(self.n_dim, dtype=int)
+        self.row_index = np.arange(self.offsets.shape[0])
+        if presolve:
+            self._presolve()
+
+    def _cache_file(self, cache_dir, content, presolve):
+        """
+        Return the name of the cache file of a constraints file
+
+        The key hashes the content of the file together with everything
+        the analysis depends on, so that an entry is never used for a file
+        that has changed since it was written.
+
+        :param cache_dir: the cache directory (string)
+        :param content: the content of the constraints file (string)
+        :param presolve: whether the linear constraints are presolved (bool)
+        """
+        key = hashlib.sha1()
+        key.update('%d %s %s %s\n' % (CACHE_VERSION, presolve, sys.version,
+                                      np.__version__))
+        key.update(content)
+        return os.path.join(cache_dir, key.hexdigest() + '.npz')
+
+    def _load_model(self, cache_file):
+        """
+        Load the analyzed model from the cache
+
+        NumPy cannot memory map the arrays of a npz archive, so the cached
+        model is read in full; it only holds the reduced linear model.
+
+        :param cache_file: name of the cache file (string)
+        :return: True if the model was loaded, False if the entry is
+            missing or unreadable
+        """
+        if not os.path.isfile(cache_file):
+            return False
+        try:
+            with np.load(cache_file) as data:
+                model = dict((key, data[key]) for key in _CACHED)
+        except Exception:
+            # A damaged entry is treated as a miss and written again
+            return False
+
+        self.__dict__.update(model)
+        self.n_dim = int(self.n_dim)
+        self.example = self.example.tolist()
+        self.linear_sources = self.linear_sources.tolist()
+        self.expr_sources = self.expr_sources.tolist()
+        return True
+
+    def _save_model(self, cache_file):
+        """
+        Save the analyzed model to the cache
+
+        The entry is written to a temporary file that is then renamed, so
+        that concurrent readers never see a partial entry. The cache is an
+        optimization: failures to write it are ignored.
+
+        :param cache_file: name of the cache file (string)
+        """
+        model = dict((key, getattr(self, key)) for key in _CACHED)
+        model['linear_sources'] = np.array(self.linear_sources, dtype=str)
+        model['expr_sources'] = np.array(self.expr_sources, dtype=str)
+
+        temporary = '%s.%d.tmp' % (cache_file, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            with open(temporary, 'wb') as f:
+                np.savez(f, **model)
+            os.rename(temporary, cache_file)
+        except (IOError, OSError):
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def _presolve(self):
+        """Move single-variable constraints to bounds, drop redundant ones"""
+        nonzero = self.coefficients != 0.0
+        single = np.sum(nonzero, axis=1) == 1
+        for row in np.flatnonzero(single):
+            j = np.flatnonzero(nonzero[row])[0]
+            bound = self.offsets[row] / self.coefficients[row, j]
+            if self.coefficients[row, j] > 0.0 and bound > self.lower[j]:
+                self.lower[j] = bound
+                self.lower_index[j] = self.row_index[row]
+            elif self.coefficients[row, j] < 0.0 and bound < self.upper[j]:
+                self.upper[j] = bound
+                self.upper_index[j] = self.row_index[row]
+        self._keep_rows(~single)
+
+        # A row is dropped if it holds wherever the remaining rows do
+        keep = np.ones(self.offsets.shape[0], dtype=bool)
+        for row in range(keep.shape[0]):
+            keep[row] = False
+            keep[row] = not self._is_redundant(row, keep)
+        self._keep_rows(keep)
+
+    def _keep_rows(self, keep):
+        """Restrict the linear model to the selected rows"""
+        self.coefficients = self.coefficients[keep]
+        self.offsets = self.offsets[keep]
+        self.row_index = self.row_index[keep]
+
+    def _is_redundant(self, row, others):
+        """
+        Check whether a row of the linear model is implied by other rows
+
+        :param row: the index of the row (int)
+        :param others: the rows that are kept (numpy.ndarray of bool)
+        """
+        coefficients, offset = self.coefficients[row], self.offsets[row]
+        if np.any(self.lower > self.upper):
+            return False
+
+        # The bounding box alone may already be enough
+        with np.errstate(invalid='ignore'):
+            lowest = np.where(coefficients > 0.0, coefficients * self.lower,
+                              coefficients * self.upper)
+        lowest = np.sum(np.where(coefficients != 0.0, lowest, 0.0))
+        tolerance = 1.0e-9 * max(1.0, abs(offset))
+        if lowest >= offset:
+            return True
+        if np.isinf(lowest) and not np.any(others):
+            return False
+
+        # Otherwise minimize the row over the remaining constraints
+        bounds = [(None if np.isinf(lo) else lo, None if np.isinf(hi) else hi)
+                  for lo, hi in zip(self.lower, self.upper)]
+        a_ub = -self.coefficients[others] if np.any(others) else None
+        b_ub = -self.offsets[others] if np.any(others) else None
+        result = scipy.optimize.linprog(coefficients, A_ub=a_ub, b_ub=b_ub,
+                                        bounds=bounds)
+        return result.status == 0 and result.fun >= offset + tolerance
+
+    def __getstate__(self):
+        """Return the picklable state; code objects are compiled again on load"""
+        state = self.__dict__.copy()
+        del state['exprs']
+        del state['ordered']
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        """Restore the state and compile the nonlinear constraints"""
+        self.__dict__.update(state)
+        self.exprs = [compile(source, "<string>", "eval")
+                      for source in self.expr_sources]
+        self.ordered = [(i, self.exprs[i]) for i in self.order]
+        self.lock = threading.Lock()
 
     def get_example(self):
         """Get the example feasible vector"""
@@ -31,13 +398,143 @@ class Constraint():
         """Get the dimension of the space on which the constraints are defined"""
         return self.n_dim
 
+    def track_rejections(self, enabled=True):
+        """
+        Enable or disable the counting of the rejections of each constraint
+
+        All linear constraints are checked at once and each violated one is
+        counted; the other constraints are evaluated in order and only the
+        first violated one is counted.
+
+        :param enabled: whether rejections are counted (bool)
+        """
+        if enabled:
+            self.linear_rejections = np.zeros(len(self.linear_sources),
+                                              dtype=int)
+            self.expr_rejections = np.zeros(len(self.exprs), dtype=int)
+        else:
+            self.linear_rejections = None
+            self.expr_rejections = None
+
+    def rejections_tracked(self):
+        """Return True if the rejections of each constraint are counted"""
+        return self.linear_rejections is not None
+
+    def get_rejections(self):
+        """Get a list of (constraint, number of rejections) pairs"""
+        return zip(self.linear_sources + self.expr_sources,
+                   self.linear_rejections.tolist() +
+                   self.expr_rejections.tolist())
+
+    def get_order(self):
+        """Get the indices of the nonlinear constraints in evaluation order"""
+        return list(self.order)
+
+    def set_order(self, order):
+        """
+        Set the evaluation order of the nonlinear constraints
+
+        :param order: indices of the nonlinear constraints, as returned by
+            get_order (list of int)
+        :raise: ValueError if order is not a permutation of the indices
+        """
+        order = [int(i) for i in order]
+        if sorted(order) != range(len(self.exprs)):
+            raise ValueError('Error: order is not a permutation of the '
+                             'nonlinear constraints')
+
+        self.order = order
+        self.ordered = [(i, self.exprs[i]) for i in order]
+        self.evaluations = 0
+        self.stops = np.zeros(len(order) + 1, dtype=int)
+
+    def _reorder(self):
+        """Sort the nonlinear constraints by decreasing rejection rate"""
+        # An expression is evaluated by every call that reaches its position
+        reached = np.cumsum(self.stops[::-1])[::-1][:-1]
+        order = np.array(self.order, dtype=int)
+
+        # Older statistics are discounted so that the order can keep up
+        self.expr_evals *= 0.5
+        self.expr_hits *= 0.5
+        self.expr_evals[order] += reached
+        self.expr_hits[order] += self.stops[:-1]
+
+        rates = self.expr_hits / np.maximum(self.expr_evals, 1.0)
+        self.set_order(np.argsort(-rates, kind='mergesort'))
+
+    def get_bounds(self):
+        """Get the lower and upper bounds on each variable"""
+        return self.lower, self.upper
+
     def apply(self, x):
         """
         Apply the constraints to a vector, returning True only if all are satisfied
 
         :param x: list or array on which to evaluate the constraints
         """
-        for expr in self.exprs:
+        below = np.less(x, self.lower)
+        above = np.greater(x, self.upper)
+        violated = np.dot(self.coefficients, x) < self.offsets
+        if below.any() or above.any() or violated.any():
+            if self.linear_rejections is not None:
+                self._count_linear_rejections(below, above, violated)
+            return False
+        return self._apply_exprs(x)
+
+    def apply_batch(self, x_batch):
+        """
+        Apply the constraints to a batch of vectors
+
+        :param x_batch: array with one vector per row
+        :return: boolean array, True for the rows that satisfy all constraints
+        """
+        below = x_batch < self.lower
+        above = x_batch > self.upper
+        violated = np.dot(x_batch, self.coefficients.T) < self.offsets
+        feasible = ~(np.any(below, axis=1) | np.any(above, axis=1) |
+                     np.any(violated, axis=1))
+        if self.linear_rejections is not None:
+            self._count_linear_rejections(np.sum(below, axis=0),
+                                          np.sum(above, axis=0),
+                                          np.sum(violated, axis=0))
+
+        # Expressions are evaluated only on rows that are still feasible
+        if self.exprs:
+            for i in np.flatnonzero(feasible):
+                feasible[i] = self._apply_exprs(x_batch[i].tolist())
+        return feasible
+
+    def _count_linear_rejections(self, below, above, violated):
+        """Charge violated bounds and rows to their linear sources"""
+        with self.lock:
+            np.add.at(self.linear_rejections, self.lower_index,
+                      np.where(self.lower_index >= 0, below, 0))
+            np.add.at(self.linear_rejections, self.upper_index,
+                      np.where(self.upper_index >= 0, above, 0))
+            np.add.at(self.linear_rejections, self.row_index, violated)
+
+    def _apply_exprs(self, x):
+        """Evaluate the nonlinear constraints on a vector"""
+        # The order and its statistics are shared by all threads
+        with self.lock:
+            return self._apply_ordered(x)
+
+    def _apply_ordered(self, x):
+        """Evaluate the nonlinear constraints in the learnt order"""
+        if 0 < self.reorder_every <= self.evaluations:
+            self._reorder()
+        self.evaluations += 1
+
+        feasible = True
+        position = 0
+        for i, expr in self.ordered:
             if not eval(expr):
-                return False
-        return True   
+                if self.expr_rejections is not None:
+                    self.expr_rejections[i] += 1
+                feasible = False
+                break
+            position += 1
+
+        self.stops[position] += 1
+        return feasible
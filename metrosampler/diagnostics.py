@@ -0,0 +1,123 @@
+import numpy as np
+
+
+def _initial_positive_sequence(rho):
+    """
+    Sum autocorrelations into integrated autocorrelation times.
+
+    The sum runs over pairs of consecutive lags and stops at the first pair
+    with negative sum (Geyer's initial positive sequence).
+
+    :param rho: autocorrelations (numpy.ndarray, one lag per row starting
+        from lag 0 and one coordinate per column)
+    :return: array with the integrated time of each coordinate
+    """
+    lags = rho.shape[0] - (rho.shape[0] - 1) % 2
+    pairs = rho[1:lags:2] + rho[2:lags:2]
+
+    # Pairs after the first negative one are excluded from the sum
+    positive = np.cumprod(pairs >= 0.0, axis=0)
+    return 1.0 + 2.0 * np.sum(pairs * positive, axis=0)
+
+
+def integrated_time(chain, max_lag=None):
+    """
+    Estimate the integrated autocorrelation time of each coordinate.
+
+    :param chain: states of the chain (numpy.ndarray, one state per row)
+    :param max_lag: maximum lag included in the estimate (int)
+    :return: array with the integrated time of each coordinate
+    """
+    nlen = chain.shape[0]
+    max_lag = max_lag if max_lag is not None else nlen // 2
+    centered = chain - np.mean(chain, 0)
+
+    # Autocovariance of all lags at once with the FFT
+    nfft = 2 ** int(np.ceil(np.log2(2 * nlen)))
+    spectrum = np.fft.rfft(centered, nfft, axis=0)
+    acov = np.fft.irfft(spectrum * np.conj(spectrum), nfft, axis=0)
+    acov = acov[:max(max_lag, 1)]
+
+    # Constant coordinates carry no information and get the longest time
+    variance = acov[0]
+    constant = variance <= 0.0
+    rho = acov / np.where(constant, 1.0, variance)
+
+    times = _initial_positive_sequence(rho)
+    times[constant] = float(nlen)
+    return times
+
+
+class AutocorrelationTracker:
+    """Online estimator of the autocorrelation of a Markov chain."""
+
+    def __init__(self, ndim, max_lag=200):
+        """
+        Initialize the tracker.
+
+        :param ndim: dimension of the states of the chain (int)
+        :param max_lag: number of lags for which the autocorrelation is
+            tracked (int)
+        """
+        self.max_lag = max_lag if max_lag > 1 else 2
+        self.nlen = 0
+
+        # States are shifted by the first one to limit cancellation errors
+        self.shift = None
+        self.sums = np.zeros(ndim)
+        self.lag_sums = np.zeros((self.max_lag, ndim))
+
+        # Every state is stored twice, so that the last max_lag states are
+        # always a contiguous slice of the history
+        self.history = np.zeros((2 * self.max_lag, ndim))
+        self.product = np.empty((self.max_lag, ndim))
+
+    def update(self, x):
+        """
+        Add a state of the chain.
+
+        :param x: the state (numpy.ndarray, must be a vector)
+        """
+        if self.shift is None:
+            self.shift = np.array(x, dtype=float)
+
+        pos = self.nlen % self.max_lag
+        np.subtract(x, self.shift, out=self.history[pos])
+        self.history[pos + self.max_lag] = self.history[pos]
+        self.nlen += 1
+
+        # Row k of the window holds the state k steps back
+        window = self.history[pos + self.max_lag:pos:-1]
+        np.multiply(window, self.history[pos], out=self.product)
+        self.lag_sums += self.product
+        self.sums += self.history[pos]
+
+    def autocovariance(self):
+        """Return the autocovariance of each coordinate, one lag per row."""
+        counts = np.maximum(self.nlen - np.arange(self.max_lag), 1)
+        mean = self.sums / max(self.nlen, 1)
+        return self.lag_sums / counts[:, np.newaxis] - mean * mean
+
+    def autocorrelation(self):
+        """Return the autocorrelation of each coordinate, one lag per row."""
+        acov = self.autocovariance()
+        return acov / np.where(acov[0] > 0.0, acov[0], 1.0)
+
+    def integrated_time(self):
+        """
+        Return the integrated autocorrelation time of each coordinate.
+
+        Lags beyond the number of states seen so far are excluded, and the
+        estimate is a lower bound if the autocorrelation is still positive
+        at the largest tracked lag.
+        """
+        lags = min(self.nlen, self.max_lag)
+        times = _initial_positive_sequence(self.autocorrelation()[:lags])
+        times[self.autocovariance()[0] <= 0.0] = float(max(self.nlen, 1))
+        return times
+
+    def effective_sample_size(self):
+        """Return the effective sample size of the least mixed coordinate."""
+        if self.nlen == 0:
+            return 0.0
+        return self.nlen / np.max(self.integrated_time())
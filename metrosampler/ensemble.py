@@ -0,0 +1,189 @@
+import checks
+import sampler
+import numpy as np
+
+
+class EnsembleSampler:
+    """
+    Generate samples from a distribution with an ensemble of adaptive
+    Metropolis chains advanced in lock-step.
+
+    The states of the chains are the rows of a single array: at every step
+    one candidate per chain is drawn, all candidates are evaluated with one
+    call to log_prob_batch and accepted or rejected with a mask, so that the
+    interpreter overhead of a step is shared by all chains. Every chain
+    adapts its own proposal as MetroSampler does, unless the moments are
+    pooled, in which case all chains share the proposal learnt from the
+    states of the whole ensemble.
+    """
+
+    def __init__(self, posterior, x_initial, covariance_initial, chains=8,
+                 update_freq=200, t0=1000, tb=10000, gamma=1.0, eps=1.0e-6,
+                 pooled=False, random_state=None):
+        """
+        Initialize the sampler.
+
+        :param posterior: distribution to sample from; log_prob_batch should
+            be vectorized (posterior.Distribution)
+        :param x_initial: a state of the sampling distribution with nonzero
+            probability, or one such state per chain (numpy.ndarray, a
+            vector or a matrix with one state per row)
+        :param covariance_initial: the initial covariance matrix used by the
+            proposal distribution (numpy.ndarray, must be a square matrix)
+        :param chains: the number of chains, ignored if x_initial holds one
+            state per chain (int)
+        :param update_freq: frequency at which the covariance is updated (int)
+        :param t0: steps before the learnt covariance matrix is used (int)
+        :param tb: length of burnin period (int)
+        :param gamma: scaling factor for the transitions step size (float)
+        :param eps: small quantity to avoid a singularity in the covariance
+            matrix of the proposal distribution (float)
+        :param pooled: whether the chains share the moments and the proposal
+            (bool)
+        :param random_state: seed or generator of the random numbers, see
+            sampler.make_random_state (int or numpy.random.RandomState)
+        """
+        # Input must be valid
+        checks.check_distribution_validity(posterior)
+        x_initial = np.array(x_initial, dtype=float)
+        if len(x_initial.shape) == 1:
+            checks.check_vector_matrix_validity(x_initial, covariance_initial)
+            x_initial = np.tile(x_initial, (max(chains, 1), 1))
+        else:
+            checks.check_batch_validity(x_initial)
+            checks.check_vector_matrix_validity(x_initial[0],
+                                                covariance_initial)
+        nchains, ndim = x_initial.shape
+
+        self.posterior = posterior
+        self.random = sampler.make_random_state(random_state)
+        self.pooled = pooled
+        self.x_last = x_initial
+        self.x_last_log_prob = posterior.log_prob_batch(self.x_last)
+
+        # Moments and proposal of every chain, or of the whole ensemble
+        shape = (1,) if pooled else (nchains,)
+        self.covariance = np.tile(covariance_initial, shape + (1, 1))
+        self.factor = np.tile(sampler.factorize_covariance(covariance_initial),
+                              shape + (1, 1))
+        self.x_mean = np.zeros(shape + (ndim,))
+        self.x_covariance = np.zeros(shape + (ndim, ndim))
+
+        self.t0 = t0
+        self.eps = eps
+        self.niter = 0
+        self.update_freq = update_freq if update_freq > 0 else 1
+        self.sd = (2.7 ** 2) * gamma / float(ndim)
+
+        # Numbers of accepted / attempted jumps of each chain since burnin
+        self.jumps_accepted = np.zeros(nchains, dtype=int)
+        self.jumps_total = np.zeros(nchains, dtype=int)
+
+        # Run the Markov chains for tb steps before starting to sample
+        for _ in range(tb):
+            self._step()
+
+    def _update_running_moments(self):
+        """Update the mean and empirical covariance matrix of the states."""
+        if self.pooled:
+            # Every step adds one state per chain to the pooled moments
+            count = float(self.niter * self.x_last.shape[0])
+            batch = float(self.x_last.shape[0])
+            diff = self.x_last - self.x_mean[0]
+            mean = np.mean(diff, 0)
+            centered = diff - mean
+            scatter = np.dot(centered.T, centered) + \
+                np.outer(mean, mean) * count * batch / (count + batch)
+            if count + batch > 1.0:
+                self.x_covariance[0] *= max(count - 1.0, 0.0)
+                self.x_covariance[0] += scatter
+                self.x_covariance[0] /= count + batch - 1.0
+            self.x_mean[0] += mean * batch / (count + batch)
+            return
+
+        # Same recursions as MetroSampler, for all chains at once
+        diff = self.x_last - self.x_mean
+        if self.niter > 0:
+            self.x_covariance *= float(self.niter - 1.0) / float(self.niter)
+            self.x_covariance += np.einsum('ki,kj->kij', diff, diff) / \
+                float(self.niter + 1.0)
+        self.x_mean += diff / float(1.0 + self.niter)
+
+    def _update_covariance(self):
+        """Update the covariance matrices used to generate candidate states."""
+        delta = self.sd * self.eps * np.identity(self.x_last.shape[1])
+        self.covariance = self.sd * self.x_covariance + delta
+        try:
+            self.factor = np.linalg.cholesky(self.covariance)
+        except np.linalg.LinAlgError:
+            self.factor = np.array([sampler.factorize_covariance(covariance)
+                                    for covariance in self.covariance])
+
+    def set_gamma(self, gamma):
+        """
+        Change the scaling factor for the transitions step size.
+
+        :param gamma: scaling factor for the transitions step size (float)
+        """
+        self.sd = (2.7 ** 2) * gamma / float(self.x_last.shape[1])
+        if self.niter > self.t0:
+            self._update_covariance()
+
+    def _step(self):
+        """
+        Implements a step of the Metropolis algorithm for all chains.
+
+        :return: boolean array, True for the chains whose proposal state is
+            accepted
+        """
+        self._update_running_moments()
+        self.niter += 1
+
+        normals = self.random.standard_normal(self.x_last.shape)
+        if self.pooled:
+            x_candidate = self.x_last + np.dot(normals, self.factor[0].T)
+        else:
+            x_candidate = self.x_last + np.einsum('kij,kj->ki', self.factor,
+                                                  normals)
+        x_candidate_log_prob = self.posterior.log_prob_batch(x_candidate)
+
+        cutoff = self.random.random_sample(self.x_last.shape[0])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            accepted = np.log(cutoff) <= \
+                x_candidate_log_prob - self.x_last_log_prob
+
+        self.x_last[accepted] = x_candidate[accepted]
+        self.x_last_log_prob[accepted] = x_candidate_log_prob[accepted]
+
+        if self.niter % self.update_freq == 0 and self.niter > self.t0:
+            self._update_covariance()
+        return accepted
+
+    def sample(self, samples_number=1, sample_every=200):
+        """
+        Generate samples from the distribution.
+
+        At every sampling time one sample is taken from each chain, until
+        the requested number of samples is reached.
+
+        :param samples_number: the total number of samples to generate (int)
+        :param sample_every: the sampling frequency (int)
+        :return: array of samples and arrays with the numbers of accepted /
+            attempted jumps of each chain
+        """
+        # Ensure sample frequency is at least one
+        sample_every = sample_every if sample_every > 0 else 1
+        nchains = self.x_last.shape[0]
+        rounds = -(-samples_number // nchains)
+
+        jumps_accepted = np.zeros(nchains, dtype=int)
+        samples_list = np.empty((rounds * nchains, self.x_last.shape[1]))
+        for i in range(rounds):
+            for _ in range(sample_every):
+                jumps_accepted += self._step()
+            samples_list[i * nchains:(i + 1) * nchains] = self.x_last
+
+        jumps_total = np.ones(nchains, dtype=int) * rounds * sample_every
+        self.jumps_accepted += jumps_accepted
+        self.jumps_total += jumps_total
+        return samples_list[:samples_number], jumps_accepted, jumps_total
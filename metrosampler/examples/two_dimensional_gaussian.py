@@ -20,12 +20,15 @@ class TwoDimensionalGaussian(sp.Distribution):
         return np.array([.2, .1])
 
     def prob(self, x):
+        return math.exp(self.log_prob(x))
+
+    def log_prob(self, x):
         # Input must be valid
         sc.check_vector_validity(x)
         sc.check_vector_size(x, self.ndim)
 
         prod = np.dot(np.dot(x.T, self.inv_covariance), x)
-        return math.exp(-prod / 2.)
+        return -prod / 2.
 
 
 def generate_samples():
@@ -0,0 +1,148 @@
+import checks
+import sampler
+import numpy as np
+import posterior as post
+
+
+class HitAndRunSampler:
+    """
+    Generate uniform samples from a polytope using the hit-and-run algorithm.
+
+    At each step a random direction is drawn and the next state is drawn
+    uniformly on the chord through the current state along that direction,
+    so that every step is accepted. The details of the algorithm are
+    described in the following article:
+
+        - R. L. Smith, Efficient Monte Carlo procedures for generating points
+          uniformly distributed over bounded regions, Operations Research
+          32(6), 1984, pp. 1296-1308
+    """
+
+    def __init__(self, posterior, x_initial=None, tb=1000, coordinate=False,
+                 refresh_every=1000, random_state=None):
+        """
+        Initialize the sampler.
+
+        :param posterior: distribution to sample from; all its constraints
+            must be linear (posterior.ConstrainedDistribution)
+        :param x_initial: a feasible state, defaults to the example of the
+            distribution (numpy.ndarray, must be a vector)
+        :param tb: length of burnin period (int)
+        :param coordinate: whether the directions are drawn among the
+            coordinate axes instead of uniformly on the sphere (bool)
+        :param refresh_every: number of steps after which the slacks of the
+            constraints are recomputed from scratch to remove round-off (int)
+        :param random_state: seed or generator of the random numbers, see
+            sampler.make_random_state (int or numpy.random.RandomState)
+        :raise: ValueError if the distribution has nonlinear constraints or
+            the initial state is not feasible
+        """
+        if not isinstance(posterior, post.ConstrainedDistribution):
+            raise ValueError('Error: input is not a constrained distribution')
+
+        constraints = posterior.constraints
+        if len(constraints.exprs) > 0:
+            raise ValueError('Error: constraints are not all linear')
+
+        x_initial = posterior.get_example() if x_initial is None \
+            else x_initial
+        checks.check_vector_validity(x_initial)
+        checks.check_vector_size(x_initial, posterior.ndim)
+
+        self.posterior = posterior
+        self.random = sampler.make_random_state(random_state)
+        self.coefficients, self.offsets, self.lower, self.upper = \
+            posterior.linear_model()
+
+        self.x_last = np.array(x_initial, dtype=float)
+        if posterior.prob(self.x_last) == 0.0:
+            raise ValueError('Error: initial state is not feasible')
+
+        self.coordinate = coordinate
+        self.refresh_every = refresh_every if refresh_every > 0 else 1
+        self.niter = 0
+        self._refresh_slack()
+
+        # Run Markov chain for tb steps before starting to sample
+        for _ in range(tb):
+            self._step()
+
+    def _refresh_slack(self):
+        """Recompute the slack of each linear constraint."""
+        self.slack = np.dot(self.coefficients, self.x_last) - self.offsets
+        np.maximum(self.slack, 0.0, out=self.slack)
+
+    def _chord(self, direction, rates):
+        """
+        Compute the chord through the current state along a direction.
+
+        :param direction: the direction (numpy.ndarray, must be a vector)
+        :param rates: the rate of change of the slack of each constraint
+            along the direction (numpy.ndarray, must be a vector)
+        :return: the smallest and largest feasible step lengths
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            limits = -self.slack / rates
+            to_lower = (self.lower - self.x_last) / direction
+            to_upper = (self.upper - self.x_last) / direction
+
+        # Bounds of the box
+        moving = direction != 0.0
+        t_min = np.max(np.where(moving, np.minimum(to_lower, to_upper),
+                                -np.inf))
+        t_max = np.min(np.where(moving, np.maximum(to_lower, to_upper),
+                                np.inf))
+
+        # Linear constraints
+        if rates.shape[0] > 0:
+            t_min = max(t_min, np.max(np.where(rates > 0.0, limits, -np.inf)))
+            t_max = min(t_max, np.min(np.where(rates < 0.0, limits, np.inf)))
+        return min(t_min, 0.0), max(t_max, 0.0)
+
+    def _step(self):
+        """
+        Implements a step of the hit-and-run algorithm.
+
+        :return: True, every state on the chord is accepted
+        """
+        ndim = self.x_last.shape[0]
+        if self.coordinate:
+            index = self.random.randint(ndim)
+            direction = np.zeros(ndim)
+            direction[index] = 1.0
+            rates = self.coefficients[:, index]
+        else:
+            direction = self.random.standard_normal(ndim)
+            direction /= np.sqrt(np.dot(direction, direction))
+            rates = np.dot(self.coefficients, direction)
+
+        t_min, t_max = self._chord(direction, rates)
+        t = t_min + (t_max - t_min) * self.random.random_sample()
+
+        self.x_last += t * direction
+        self.slack += t * rates
+
+        self.niter += 1
+        if self.niter % self.refresh_every == 0:
+            self._refresh_slack()
+        return True
+
+    def sample(self, samples_number=1, sample_every=200):
+        """
+        Generate samples from the distribution.
+
+        :param samples_number: the number of samples to generate (int)
+        :param sample_every: the sampling frequency (int)
+        :return: list of samples and numbers of accepted / attempted jumps
+        """
+        # Ensure sample frequency is at least one
+        sample_every = sample_every if sample_every > 0 else 1
+
+        samples_list = np.empty((samples_number, self.x_last.shape[0]))
+        for i in range(samples_number):
+            for _ in range(sample_every):
+                self._step()
+            samples_list[i] = self.x_last
+
+        jumps_total = samples_number * sample_every
+        return samples_list, jumps_total, jumps_total
@@ -0,0 +1,176 @@
+import os
+import json
+import numpy as np
+
+FORMATS = ('txt', 'npy')
+
+# First bytes of every .npy file
+NPY_MAGIC = b'\x93NUMPY'
+
+
+class TextWriter:
+    """Write samples to a text file, one sample per line."""
+
+    def __init__(self, fname, position=0):
+        """
+        Open the output file.
+
+        :param fname: name of the output file (string)
+        :param position: number of samples of the file to keep, the rest of
+            the file is dropped (int)
+        """
+        # Samples are kept up to the end of the line of the last one
+        size = 0
+        self.rows = 0
+        if position > 0 and os.path.isfile(fname):
+            with open(fname, 'r') as f:
+                for line in f:
+                    if self.rows == position or not line.endswith('\n'):
+                        break
+                    size += len(line)
+                    self.rows += 1
+
+        self.file = open(fname, 'a')
+        self.file.truncate(size)
+
+    def write(self, samples):
+        """
+        Append samples to the output.
+
+        :param samples: the samples, one per row (numpy.ndarray)
+        """
+        np.savetxt(self.file, samples, delimiter=' ', fmt='%1.4e')
+        self.rows += samples.shape[0]
+
+    def flush(self):
+        """Make the samples written so far durable."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def position(self):
+        """Return the number of samples written so far."""
+        return self.rows
+
+    def close(self):
+        """Close the output file."""
+        self.file.close()
+
+
+class NpyWriter:
+    """Write samples to a memory-mapped .npy file allocated in advance."""
+
+    def __init__(self, fname, ndim, samples_number, dtype=np.float64,
+                 position=0):
+        """
+        Open the output file.
+
+        A file that already holds an array of the requested shape and type
+        is reopened, so that samples can be written after the first
+        position ones; otherwise a new file is created.
+
+        :param fname: name of the output file (string)
+        :param ndim: dimension of the samples (int)
+        :param samples_number: the number of samples of the file (int)
+        :param dtype: type of the stored values (numpy.dtype)
+        :param position: number of samples already in the file (int)
+        """
+        shape = (samples_number, ndim)
+        self.array = None
+        if position > 0 and os.path.isfile(fname):
+            array = np.load(fname, mmap_mode='r+')
+            if array.shape == shape and array.dtype == np.dtype(dtype):
+                self.array = array
+        if self.array is None:
+            self.array = np.lib.format.open_memmap(fname, mode='w+',
+                                                   dtype=dtype, shape=shape)
+            position = 0
+        self.cursor = position
+
+    def write(self, samples):
+        """
+        Store samples after the ones already written.
+
+        :param samples: the samples, one per row (numpy.ndarray)
+        """
+        self.array[self.cursor:self.cursor + samples.shape[0]] = samples
+        self.cursor += samples.shape[0]
+
+    def flush(self):
+        """Make the samples written so far durable."""
+        self.array.flush()
+
+    def position(self):
+        """Return the number of samples written so far."""
+        return self.cursor
+
+    def close(self):
+        """Flush the samples and release the memory map."""
+        self.array.flush()
+        self.array = None
+
+
+def open_writer(fname, fmt, ndim, samples_number, dtype=np.float64,
+                position=0):
+    """
+    Open a writer for samples in the given format.
+
+    :param fname: name of the output file (string)
+    :param fmt: the format of the output, one of FORMATS (string)
+    :param ndim: dimension of the samples (int)
+    :param samples_number: the number of samples of the file (int)
+    :param dtype: type of the stored values, for binary formats
+        (numpy.dtype)
+    :param position: the number of samples of a previous run of the same
+        output after which the new samples are written; writing resumes
+        after fewer samples if the file holds less (int)
+    :return: the writer
+    :raise: ValueError if the format is not supported
+    """
+    if fmt == 'txt':
+        return TextWriter(fname, position)
+    if fmt == 'npy':
+        return NpyWriter(fname, ndim, samples_number, dtype, position)
+    raise ValueError('Error: output format is not supported')
+
+
+def metadata_file(fname):
+    """Return the name of the metadata file of an output file."""
+    return fname + '.json'
+
+
+def save_metadata(fname, **metadata):
+    """
+    Save the metadata of an output file next to it, in JSON format.
+
+    :param fname: name of the output file (string)
+    :param metadata: the values to save
+    """
+    with open(metadata_file(fname), 'w') as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+
+
+def load_samples(fname, mmap=True):
+    """
+    Load the samples of an output file.
+
+    The format is recognized from the content of the file, whatever its
+    name. Binary files are memory-mapped by default, so that the samples are
+    read from disk only when they are used.
+
+    :param fname: name of the output file (string)
+    :param mmap: whether binary files are memory-mapped (bool)
+    :return: the samples, one per row, and the metadata saved with them, or
+        None if there is no metadata file
+    """
+    with open(fname, 'rb') as f:
+        binary = f.read(len(NPY_MAGIC)) == NPY_MAGIC
+    if binary:
+        samples = np.load(fname, mmap_mode='r' if mmap else None)
+    else:
+        samples = np.loadtxt(fname, ndmin=2)
+
+    metadata = None
+    if os.path.isfile(metadata_file(fname)):
+        with open(metadata_file(fname), 'r') as f:
+            metadata = json.load(f)
+    return samples, metadata
@@ -0,0 +1,137 @@
+import multiprocessing
+import numpy as np
+import sampler
+
+
+def _run_chain(args):
+    """
+    Run an independent chain and return its samples.
+
+    Executed in the worker processes: the arguments are packed in a tuple so
+    that the function can be used with multiprocessing.Pool.map.
+    """
+    posterior, x_initial, covariance_initial, kwargs, samples_number, \
+        sample_every, seed = args
+
+    chain = sampler.MetroSampler(posterior, x_initial, covariance_initial,
+                                 random_state=seed, **kwargs)
+    return chain.sample(samples_number, sample_every)
+
+
+def _run_trial(args):
+    """
+    Run a trial chain and return its acceptance ratio and the chain itself.
+
+    Executed in the worker processes, see _run_chain.
+    """
+    posterior, x_initial, covariance_initial, kwargs, gamma, samples_number, \
+        sample_every, seed = args
+
+    chain = sampler.MetroSampler(posterior, x_initial, covariance_initial,
+                                 gamma=gamma, random_state=seed, **kwargs)
+    _, jumps_accepted, jumps_total = chain.sample(samples_number, sample_every)
+    return float(jumps_accepted) / float(jumps_total), chain
+
+
+def _map(function, tasks, workers):
+    """Apply function to the tasks on a pool of workers, or serially."""
+    if workers <= 1:
+        return [function(task) for task in tasks]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(function, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def sample_chains(posterior, x_initial, covariance_initial, samples_number=1,
+                  sample_every=200, chains=2, workers=None, seed=None,
+                  **kwargs):
+    """
+    Generate samples from a distribution using independent parallel chains.
+
+    Every chain is an adaptive MetroSampler started from x_initial and run in
+    its own worker process with its own random number generator, seeded
+    from seed. The requested samples are split evenly among the chains and
+    merged in chain order.
+
+    :param posterior: distribution to sample from (posterior.Distribution,
+        must be picklable)
+    :param x_initial: a state of the sampling distribution with nonzero
+        probability (numpy.ndarray, must be a vector)
+    :param covariance_initial: the initial covariance matrix used by the
+        proposal distribution (numpy.ndarray, must be a square matrix)
+    :param samples_number: the total number of samples to generate (int)
+    :param sample_every: the sampling frequency (int)
+    :param chains: the number of independent chains (int)
+    :param workers: the number of worker processes; defaults to the
+        smaller of chains and the number of CPUs, and 1 runs the chains
+        in the calling process (int)
+    :param seed: seed or generator used to generate the seeds of the
+        chains; defaults to NumPy's global generator (int or
+        numpy.random.RandomState)
+    :param kwargs: additional arguments passed to MetroSampler
+    :return: array of samples and arrays with the numbers of accepted /
+        attempted jumps of each chain
+    """
+    chains = chains if chains > 0 else 1
+    if workers is None:
+        workers = min(chains, multiprocessing.cpu_count())
+
+    # Split the samples among chains, each chain with its own seed
+    seeds = sampler.spawn_seeds(seed, chains)
+    counts = [samples_number // chains + (1 if i < samples_number % chains
+                                          else 0) for i in range(chains)]
+    tasks = [(posterior, x_initial, covariance_initial, kwargs, counts[i],
+              sample_every, seeds[i]) for i in range(chains)]
+
+    results = _map(_run_chain, tasks, workers)
+    samples_list = np.concatenate([result[0] for result in results], 0)
+    jumps_accepted = np.array([result[1] for result in results])
+    jumps_total = np.array([result[2] for result in results])
+    return samples_list, jumps_accepted, jumps_total
+
+
+def evaluate_gammas(posterior, x_initial, covariance_initial, gammas,
+                    samples_number=2000, sample_every=10, workers=None,
+                    seed=None, **kwargs):
+    """
+    Run trial chains for several step size scalings in parallel.
+
+    Every value of gamma is tried on its own adaptive MetroSampler, run in a
+    worker process with its own random number generator, and the chains are
+    returned so that the best one can be used for sampling without a new
+    burnin.
+
+    :param posterior: distribution to sample from (posterior.Distribution,
+        must be picklable)
+    :param x_initial: a state of the sampling distribution with nonzero
+        probability (numpy.ndarray, must be a vector)
+    :param covariance_initial: the initial covariance matrix used by the
+        proposal distribution (numpy.ndarray, must be a square matrix)
+    :param gammas: the values of the scaling factor to try (list of float)
+    :param samples_number: the number of samples generated by each trial
+        (int)
+    :param sample_every: the sampling frequency of each trial (int)
+    :param workers: the number of worker processes; defaults to the
+        smaller of the number of trials and the number of CPUs (int)
+    :param seed: seed or generator used to generate the seeds of the
+        trials; defaults to NumPy's global generator (int or
+        numpy.random.RandomState)
+    :param kwargs: additional arguments passed to MetroSampler
+    :return: array with the acceptance ratio of each trial and list with
+        the chain of each trial
+    """
+    if workers is None:
+        workers = min(len(gammas), multiprocessing.cpu_count())
+
+    seeds = sampler.spawn_seeds(seed, len(gammas))
+    tasks = [(posterior, x_initial, covariance_initial, kwargs, gammas[i],
+              samples_number, sample_every, seeds[i])
+             for i in range(len(gammas))]
+
+    results = _map(_run_trial, tasks, workers)
+    ratios = np.array([result[0] for result in results])
+    return ratios, [result[1] for result in results]
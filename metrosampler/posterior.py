@@ -21,23 +21,144 @@ class Distribution:
         """
         raise NotImplementedError('Abstract method to be implemented')
 
+    def log_prob(self, x):
+        """
+        Evaluate the logarithm of the probability density of a state.
+
+        The default implementation takes the logarithm of prob; distributions
+        whose density under- or overflows should override it. The density
+        does not need to be normalized.
+
+        :param x: the state to be evaluated (numpy.ndarray, must be a vector)
+        :return: the logarithm of the probability density of the input state,
+            -inf if the state has zero probability
+        """
+        with np.errstate(divide='ignore'):
+            return np.log(self.prob(x))
+
+    def prob_batch(self, x_batch):
+        """
+        Evaluate the probability density of a batch of states.
+
+        The default implementation evaluates the states one at a time;
+        distributions that can do better should override it.
+
+        :param x_batch: the states to be evaluated (numpy.ndarray, must be
+            a matrix with one state per row)
+        :return: the probability densities of the input states
+            (numpy.ndarray)
+        """
+        return np.array([self.prob(x) for x in x_batch], dtype=float)
+
+    def log_prob_batch(self, x_batch):
+        """
+        Evaluate the logarithm of the probability density of a batch of states.
+
+        :param x_batch: the states to be evaluated (numpy.ndarray, must be
+            a matrix with one state per row)
+        :return: the logarithms of the probability densities of the input
+            states (numpy.ndarray)
+        """
+        with np.errstate(divide='ignore'):
+            return np.log(self.prob_batch(x_batch))
+
 
 class ConstrainedDistribution(Distribution):
     """Define a uniform distribution with constraints on the hypercube."""
 
-    def __init__(self, constraints):
+    def __init__(self, constraints, rescale=False):
         """
         Initialize the constrained distribution.
 
+        The hypercube is narrowed to the bounds of the constraints. If rescale
+        is True the distribution is defined on the unit hypercube, mapped
+        linearly onto the narrowed box: the proposal then sees every variable
+        on the same scale. Samples are mapped back with to_original.
+
         :param constraints: the constraints imposed on the distribution
             (constraints.Constraint)
+        :param rescale: whether to rescale the box to the unit hypercube
+            (bool)
         """
         self.constraints = constraints
         self.ndim = constraints.get_ndim()
 
+        # Constraints that do not provide bounds keep the unit hypercube
+        get_bounds = getattr(constraints, 'get_bounds', None)
+        if get_bounds is not None:
+            lower, upper = get_bounds()
+        else:
+            lower, upper = -np.inf, np.inf
+        self.box_lower = np.maximum(lower, 0.0) * np.ones(self.ndim)
+        self.box_upper = np.minimum(upper, 1.0) * np.ones(self.ndim)
+
+        # Bounds of the states in the space of the distribution
+        self.rescale = rescale
+        if rescale:
+            self.lower = np.zeros(self.ndim)
+            self.upper = np.ones(self.ndim)
+        else:
+            self.lower = self.box_lower
+            self.upper = self.box_upper
+
+    def to_original(self, x):
+        """
+        Map states of the distribution to the variables of the constraints.
+
+        :param x: the states (numpy.ndarray, a vector or one state per row)
+        :return: the mapped states, x itself if the box is not rescaled
+        """
+        if not self.rescale:
+            return x
+        return self.box_lower + x * (self.box_upper - self.box_lower)
+
+    def from_original(self, x):
+        """
+        Map states of the constraints to the space of the distribution.
+
+        :param x: the states (numpy.ndarray, a vector or one state per row)
+        :return: the mapped states, x itself if the box is not rescaled
+        """
+        if not self.rescale:
+            return x
+        width = self.box_upper - self.box_lower
+        return (x - self.box_lower) / np.where(width > 0.0, width, 1.0)
+
+    def linear_model(self):
+        """
+        Return the linear constraints in the space of the distribution.
+
+        :return: matrix A, vector b, lower and upper bounds such that the
+            linear constraints read A . x >= b
+        """
+        coefficients = self.constraints.coefficients
+        offsets = self.constraints.offsets
+        if self.rescale:
+            offsets = offsets - np.dot(coefficients, self.box_lower)
+            coefficients = coefficients * (self.box_upper - self.box_lower)
+        return coefficients, offsets, self.lower, self.upper
+
+    def _inside(self, x_batch):
+        """
+        Check which states lie inside the box.
+
+        While the constraints count their rejections, only the unit
+        hypercube is checked here, so that the bounds are checked and their
+        rejections counted by the constraints.
+
+        :param x_batch: the states (numpy.ndarray, one state per row)
+        :return: boolean array, True for the states inside the box
+        """
+        tracked = getattr(self.constraints, 'rejections_tracked', None)
+        if tracked is not None and tracked():
+            x_batch = self.to_original(x_batch)
+            return np.all((x_batch >= 0.0) & (x_batch <= 1.0), axis=1)
+        return np.all((x_batch >= self.lower) & (x_batch <= self.upper),
+                      axis=1)
+
     def get_example(self):
         """Return a feasible state of the distribution."""
-        return np.array(self.constraints.get_example())
+        return self.from_original(np.array(self.constraints.get_example()))
 
     def prob(self, x):
         """
@@ -53,13 +174,46 @@ class ConstrainedDistribution(Distribution):
         checks.check_vector_validity(x)
         checks.check_vector_size(x, self.ndim)
 
-        # x must belong to the n-dimensional hypercube
-        for val in x:
-            if val < 0 or val > 1.0:
-                return 0.0
+        # x must belong to the box
+        if not self._inside(x[np.newaxis])[0]:
+            return 0.0
 
-        valid_constraints = self.constraints.apply(x.tolist())
+        valid_constraints = self.constraints.apply(self.to_original(x))
         if valid_constraints:
             return 1.0
 
         return 0.0
+
+    def log_prob(self, x):
+        """
+        Evaluate the logarithm of the density of the input state.
+
+        :param x: the state to be evaluated (numpy.ndarray, must be a vector
+            of valid size)
+        :return: 0 if the state lies in the feasible region, -inf otherwise
+        """
+        return 0.0 if self.prob(x) > 0.0 else -np.inf
+
+    def prob_batch(self, x_batch):
+        """
+        Evaluate whether the input states are in the feasible region or not.
+
+        :param x_batch: the states to be evaluated (numpy.ndarray, must be a
+            matrix with one state of valid size per row)
+        :return: array with 1 for the states that lie in the feasible region
+            and 0 for the others
+        :raise: ValueError if the dimension of the input states differs from
+            the dimension of the underlying constraints object
+        """
+        # Input must be valid
+        checks.check_batch_validity(x_batch)
+        checks.check_batch_size(x_batch, self.ndim)
+
+        # Constraints are applied only to states inside the box
+        inside = self._inside(x_batch)
+
+        probs = np.zeros(x_batch.shape[0])
+        if np.any(inside):
+            probs[inside] = self.constraints.apply_batch(
+                self.to_original(x_batch[inside]))
+        return probs
@@ -0,0 +1,93 @@
+import timeit
+
+PHASES = ('moments', 'proposal', 'posterior', 'adaptation')
+
+
+class SamplerProfile:
+    """Timings and counters collected while a sampler runs."""
+
+    def __init__(self, window=1000):
+        """
+        Initialize the profile.
+
+        :param window: number of steps over which each value of the rolling
+            acceptance rate is computed (int)
+        """
+        self.timings = dict((phase, 0.0) for phase in PHASES)
+        self.steps = 0
+        self.accepted = 0
+
+        self.window = window if window > 0 else 1
+        self.window_accepted = 0
+        self.acceptance_trace = []
+
+    def start(self):
+        """Return the current time, to be passed to lap."""
+        return timeit.default_timer()
+
+    def lap(self, phase, start):
+        """
+        Charge the time elapsed since start to a phase.
+
+        :param phase: the phase the time is charged to (string)
+        :param start: the time at which the phase started (float)
+        :return: the current time, i.e. the start of the next phase
+        """
+        now = timeit.default_timer()
+        self.timings[phase] += now - start
+        return now
+
+    def record_step(self, accepted):
+        """
+        Count a step and update the rolling acceptance rate.
+
+        :param accepted: whether the candidate state was accepted (bool)
+        """
+        self.steps += 1
+        if accepted:
+            self.accepted += 1
+            self.window_accepted += 1
+
+        if self.steps % self.window == 0:
+            rate = float(self.window_accepted) / float(self.window)
+            self.acceptance_trace.append(rate)
+            self.window_accepted = 0
+
+    def report(self, constraints=None):
+        """
+        Format the collected timings and counters.
+
+        :param constraints: constraints whose rejection counts are included
+            in the report (constraints.Constraint)
+        :return: the report (string)
+        """
+        lines = []
+        rate = float(self.accepted) / float(self.steps) if self.steps else 0.0
+        lines.append('Steps: %d, accepted: %d (%.4f)' %
+                     (self.steps, self.accepted, rate))
+
+        total = sum(self.timings.values())
+        lines.append('')
+        lines.append('%-12s %12s %8s %12s' %
+                     ('phase', 'time (s)', 'share', 'us / step'))
+        for phase in PHASES:
+            elapsed = self.timings[phase]
+            share = 100.0 * elapsed / total if total > 0.0 else 0.0
+            per_step = 1.0e6 * elapsed / self.steps if self.steps else 0.0
+            lines.append('%-12s %12.4f %7.1f%% %12.2f' %
+                         (phase, elapsed, share, per_step))
+        if total > 0.0:
+            bound = max(PHASES, key=lambda phase: self.timings[phase])
+            lines.append('The run is bound by: %s' % bound)
+
+        lines.append('')
+        lines.append('Acceptance rate over windows of %d steps:' % self.window)
+        lines.append(' '.join('%.3f' % val for val in self.acceptance_trace))
+
+        if constraints is not None and constraints.rejections_tracked():
+            lines.append('')
+            lines.append('%10s  constraint' % 'rejections')
+            for source, count in constraints.get_rejections():
+                lines.append('%10d  %s' % (count, source.strip()))
+
+        return '\n'.join(lines) + '\n'
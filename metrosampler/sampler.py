@@ -1,14 +1,51 @@
+import os
+import math
 import checks
+import diagnostics
 import numpy as np
+import multiprocessing.pool
 
 
-def sample_gauss(covariance, samples=1):
+def make_random_state(seed=None):
+    """
+    Return the random number generator of a sampler.
+
+    :param seed: None for NumPy's global generator, a seed for a new
+        generator, or a generator, returned as is (int or
+        numpy.random.RandomState)
+    :return: the generator (numpy.random.RandomState)
+    """
+    if seed is None:
+        return np.random.mtrand._rand
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+
+def spawn_seeds(seed, streams):
+    """
+    Draw the seeds of independent child streams.
+
+    The seeds are drawn from the generator returned by make_random_state,
+    so that the child streams are reproducible whenever the parent is.
+
+    :param seed: seed or generator of the parent stream (int or
+        numpy.random.RandomState)
+    :param streams: the number of child streams (int)
+    :return: array of seeds, one per child stream
+    """
+    return make_random_state(seed).randint(0, 2 ** 31 - 1, streams)
+
+
+def sample_gauss(covariance, samples=1, random_state=None):
     """
     Generate samples from a multivariate Gaussian distribution.
 
     :param covariance: distribution covariance (numpy.ndarray, must be
         a square matrix)
     :param samples: number of samples to generate (int)
+    :param random_state: seed or generator, see make_random_state (int or
+        numpy.random.RandomState)
     :return: array of samples from a multivariate Gaussian distribution
     """
     # Input must be valid
@@ -16,7 +53,120 @@ def sample_gauss(covariance, samples=1):
 
     ndim = covariance.shape[0]
     samples = samples if samples > 0 else 1
-    return np.random.multivariate_normal(np.zeros(ndim), covariance, samples)
+    return make_random_state(random_state).multivariate_normal(
+        np.zeros(ndim), covariance, samples)
+
+
+def make_structure(structure, ndim):
+    """
+    Validate the structure of an adaptive covariance.
+
+    :param structure: None or 'dense' for a full covariance matrix,
+        'diagonal' for variances only, or a list of blocks of variable
+        indices partitioning the variables, for a block-diagonal covariance
+        (string or list of lists of int)
+    :param ndim: the number of variables (int)
+    :return: the name of the structure and the list of blocks, empty unless
+        the covariance is block-diagonal
+    :raise: ValueError if the structure is not valid
+    """
+    if structure is None or structure == 'dense':
+        return 'dense', []
+    if isinstance(structure, str):
+        if structure != 'diagonal':
+            raise ValueError('Error: covariance structure is not supported')
+        return 'diagonal', []
+
+    blocks = [np.array(block, dtype=int) for block in structure]
+    if len(blocks) == 0 or np.any(np.sort(np.concatenate(blocks)) !=
+                                  np.arange(ndim)):
+        raise ValueError('Error: blocks must partition the variables')
+    return 'blocks', blocks
+
+
+def _log_prob(args):
+    """Evaluate the logarithm of the density of a state on a pool."""
+    posterior, x = args
+    return posterior.log_prob(x)
+
+
+def factorize_covariance(covariance):
+    """
+    Compute a square root of a covariance matrix.
+
+    :param covariance: the matrix to factorize (numpy.ndarray, must be a
+        symmetric positive semi-definite matrix)
+    :return: a matrix L such that L L^T equals covariance; L is the
+        Cholesky factor unless covariance is singular
+    """
+    try:
+        return np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError:
+        # Singular matrices have no Cholesky factor, fall back to the SVD
+        u, s, _ = np.linalg.svd(covariance)
+        return u * np.sqrt(s)
+
+
+def cholesky_update(factor, vectors, block_size=64):
+    """
+    Update a Cholesky factor in place with a rank-k modification.
+
+    The factor L is overwritten with the lower triangular L' such that
+    L' L'^T = L L^T + V V^T. One Householder reflection per column folds the
+    k update vectors into the factor; the reflections are applied to the
+    columns of a panel one at a time and to the rest of the factor as a
+    block, so the update costs O(k d^2) operations instead of the O(d^3)
+    of a new factorization.
+
+    :param factor: lower triangular factor with positive diagonal
+        (numpy.ndarray, must be a square matrix)
+    :param vectors: the update vectors, one per column (numpy.ndarray, must
+        be a d x k matrix)
+    :param block_size: number of columns per panel (int)
+    """
+    ndim = factor.shape[0]
+    upper = factor.T
+    rows = np.array(vectors.T, dtype=float)
+    for start in range(0, ndim, block_size):
+        stop = min(start + block_size, ndim)
+        heads = np.zeros(stop - start)
+        betas = np.zeros(stop - start)
+
+        # Reflections that zero the update vectors within the panel
+        for i, j in enumerate(range(start, stop)):
+            column = rows[:, j]
+            sigma = np.dot(column, column)
+            if sigma == 0.0:
+                continue
+
+            pivot = upper[j, j]
+            alpha = math.sqrt(pivot * pivot + sigma)
+            heads[i] = -sigma / (pivot + alpha)
+            betas[i] = 2.0 / (heads[i] * heads[i] + sigma)
+
+            proj = heads[i] * upper[j, j + 1:stop] + \
+                np.dot(column, rows[:, j + 1:stop])
+            upper[j, j + 1:stop] -= betas[i] * heads[i] * proj
+            rows[:, j + 1:stop] -= betas[i] * np.outer(column, proj)
+            upper[j, j] = alpha
+
+        if stop == ndim:
+            break
+
+        # Accumulate the reflections as I - Y T Y^T and apply them at once
+        reflectors = rows[:, start:stop]
+        gram = np.dot(reflectors.T, reflectors)
+        block = np.zeros((stop - start, stop - start))
+        for i in range(stop - start):
+            block[:i, i] = -betas[i] * np.dot(block[:i, :i], gram[:i, i])
+            block[i, i] = betas[i]
+
+        trailing = upper[start:stop, stop:]
+        proj = heads[:, np.newaxis] * trailing + \
+            np.dot(reflectors.T, rows[:, stop:])
+        proj = np.dot(block.T, proj)
+        trailing -= heads[:, np.newaxis] * proj
+        rows[:, stop:] -= np.dot(reflectors, proj)
 
 
 class MetroSampler:
@@ -27,10 +177,35 @@ class MetroSampler:
 
         - H. Haairo, E. Saksman, and J. Tamminen, An adaptive metropolis
           algorithm, Bernoulli 7(2), 2001, pp. 223-242
+
+    Optionally a rejected candidate is followed, within the same step, by a
+    second candidate drawn from the proposal shrunk by dr_scale, as in the
+    delayed rejection adaptive Metropolis algorithm:
+
+        - H. Haario, M. Laine, A. Mira, and E. Saksman, DRAM: Efficient
+          adaptive MCMC, Statistics and Computing 16(4), 2006, pp. 339-354
+
+    For expensive densities the candidates can be evaluated speculatively:
+    the next candidates of the block are evaluated together on a pool,
+    assuming that the chain rejects them and stays at its state, and the
+    results are dropped as soon as a candidate is accepted. The chain is the
+    same as with serial evaluation.
+
+    Random numbers come from the generator of the sampler, NumPy's global
+    one unless a seed or a generator is given; normals and uniforms are
+    drawn in blocks together with the candidates.
+
+    In high dimension the learnt covariance can be restricted to its
+    diagonal, or to blocks of variables: the moments, the proposal and its
+    factor are then stored as vectors of variances or as one matrix per
+    block, and their cost scales with the structure instead of the square
+    of the dimension.
     """
 
     def __init__(self, posterior, x_initial, covariance_initial,
-                 update_freq=200, t0=1000, tb=10000, gamma=1.0, eps=1.0e-6):
+                 update_freq=200, t0=1000, tb=10000, gamma=1.0, eps=1.0e-6,
+                 dr_scale=None, low_rank_updates=False, speculate=0,
+                 pool=None, random_state=None, structure=None):
         """
         Initialize the sampler.
 
@@ -38,95 +213,496 @@ class MetroSampler:
         :param x_initial: a state of the sampling distribution with nonzero
             probability (numpy.ndarray, must be a vector)
         :param covariance_initial: the initial covariance matrix used by the
-            proposal distribution (numpy.ndarray, must be a square matrix)
+            proposal distribution, or the vector of its variances if the
+            covariance is structured (numpy.ndarray, must be a square matrix)
         :param update_freq: frequency at which the covariance is updated (int)
         :param t0: steps before the learnt covariance matrix is used (int)
         :param tb: length of burnin period (int)
         :param gamma: scaling factor for the transitions step size (float)
         :param eps: small quantity to avoid a singularity in the covariance
             matrix of the proposal distribution (float)
+        :param dr_scale: scaling factor of the steps of the second candidate
+            tried after a rejection, None to disable delayed rejection
+            (float)
+        :param low_rank_updates: whether the moments are updated once per
+            block of update_freq steps and the factor of the proposal
+            covariance is updated with the states of the block instead of
+            being recomputed (bool)
+        :param speculate: the number of candidates evaluated together, 0 or
+            1 to evaluate them one at a time; statistics collected by the
+            posterior, such as the rejections and the evaluation order of
+            constraints.Constraint, include the discarded evaluations (int)
+        :param pool: pool with a map method on which the candidates are
+            evaluated; a process pool requires a picklable posterior.
+            Defaults to a pool of speculate threads, which only speeds up
+            densities that release the interpreter lock
+            (multiprocessing.pool.Pool)
+        :param random_state: seed or generator of the random numbers, see
+            make_random_state (int or numpy.random.RandomState)
+        :param structure: structure of the learnt covariance, see
+            make_structure; low-rank updates require a dense covariance
+            (string or list of lists of int)
+        :raise: ValueError if the structure is not valid
         """
         # Input must be valid
         checks.check_distribution_validity(posterior)
-        checks.check_vector_matrix_validity(x_initial, covariance_initial)
+        self.structure, self.blocks = make_structure(
+            structure, np.shape(x_initial)[0])
+        if self.structure != 'dense' and len(covariance_initial.shape) == 1:
+            checks.check_vector_validity(x_initial)
+            checks.check_vector_size(covariance_initial, x_initial.shape[0])
+        else:
+            checks.check_vector_matrix_validity(x_initial, covariance_initial)
+        if self.structure != 'dense' and low_rank_updates:
+            raise ValueError('Error: low-rank updates require a dense '
+                             'covariance')
 
         self.posterior = posterior
-        self.covariance = covariance_initial
-
-        self.x_last = x_initial
-        self.x_last_probability = posterior.prob(x_initial)
+        self.random = make_random_state(random_state)
+        self.covariance = self._restrict(covariance_initial)
+        self.factor = self._factorize(self.covariance)
+
+        ndim = x_initial.shape[0]
+        self.x_last = np.array(x_initial, dtype=float)
+        self.x_last_log_prob = posterior.log_prob(self.x_last)
+        self.x_candidate = np.empty(x_initial.shape)
         self.x_mean = np.zeros(x_initial.shape)
-        self.x_covariance = np.zeros(covariance_initial.shape)
+        self.x_covariance = self._restrict(np.zeros(ndim)) \
+            if self.structure != 'dense' else np.zeros((ndim, ndim))
+
+        # Work buffers for the moments updates
+        self.diff = np.empty(x_initial.shape)
+        self.outer = np.empty((ndim, ndim)) if self.structure == 'dense' \
+            else None
 
         self.t0 = t0
         self.eps = eps
         self.niter = 0
 
-        self.candidates = None
+        # Numbers of accepted / attempted jumps since burnin
+        self.jumps_accepted = 0
+        self.jumps_total = 0
+
+        # Optional instrumentation: a profiling.SamplerProfile collecting
+        # timings and a function called as step_callback(sampler, accepted)
+        self.profile = None
+        self.step_callback = None
+
+        # Autocorrelation tracker of the last run of sample_until_ess
+        self.autocorrelation = None
+
+        # Candidate steps are drawn in blocks with the uniforms of their
+        # acceptance tests, the cursor marks the next one; the standard
+        # normals they are drawn from are kept for the delayed rejection
         self.update_freq = update_freq if update_freq > 0 else 1
+        self.candidates = np.empty((self.update_freq, x_initial.shape[0]))
+        self.normals = np.empty(self.candidates.shape)
+        self.uniforms = np.empty(self.update_freq)
+        self.cursor = self.update_freq
         self.sd = (2.7 ** 2) * gamma / float(x_initial.shape[0])
 
+        # Delayed rejection: second candidates tried and accepted
+        self.dr_scale = dr_scale
+        self.dr_first = np.empty(x_initial.shape)
+        self.dr_total = 0
+        self.dr_accepted = 0
+
+        # Low-rank updates: differences from the mean collected over the
+        # current block, and the regularization included in the factor,
+        # None until the factor comes from the learnt covariance
+        self.low_rank_updates = low_rank_updates
+        self.block = np.empty(self.candidates.shape) if low_rank_updates \
+            else None
+        self.block_niter = np.empty(self.update_freq)
+        self.block_size = 0
+        self.eps_factor = None
+
+        # Speculative evaluation: densities of the candidates from the first
+        # to the last speculated index, valid while the chain stays at its
+        # state and the block of candidates is unchanged
+        self.speculate = speculate if speculate > 1 else 0
+        self.pool = pool
+        self.own_pool = False
+        self.speculated = np.empty(self.update_freq)
+        self.speculated_from = 0
+        self.speculated_to = 0
+
         # Run Markov chain for tb steps before starting to sample
         for _ in range(tb):
             self._step()
 
+    def _restrict(self, covariance):
+        """
+        Keep the entries of a covariance matrix allowed by the structure.
+
+        :param covariance: the covariance matrix, or its variances for a
+            structured covariance (numpy.ndarray)
+        :return: the covariance matrix, its variances or its blocks
+        """
+        if self.structure == 'dense':
+            return covariance
+        if len(covariance.shape) == 1:
+            if self.structure == 'diagonal':
+                return np.array(covariance, dtype=float)
+            return [np.diag(covariance[block]) for block in self.blocks]
+        if self.structure == 'diagonal':
+            return np.array(np.diag(covariance), dtype=float)
+        return [covariance[np.ix_(block, block)] for block in self.blocks]
+
+    def _factorize(self, covariance):
+        """
+        Factorize a covariance with the structure of the sampler.
+
+        :param covariance: the covariance matrix, its variances or its blocks
+        :return: the factor of the matrix, the standard deviations or the
+            factors of the blocks
+        """
+        if self.structure == 'diagonal':
+            return np.sqrt(covariance)
+        if self.structure == 'blocks':
+            return [factorize_covariance(block) for block in covariance]
+        return factorize_covariance(covariance)
+
+    def _pack(self, matrices):
+        """Concatenate the matrices of the blocks into a single vector."""
+        if self.structure != 'blocks':
+            return matrices
+        return np.concatenate([matrix.ravel() for matrix in matrices])
+
+    def _unpack(self, values):
+        """Split a vector built by _pack into the matrices of the blocks."""
+        if self.structure != 'blocks':
+            return values
+        sizes = [block.shape[0] for block in self.blocks]
+        ends = np.cumsum([size * size for size in sizes])
+        return [values[end - size * size:end].reshape(size, size)
+                for end, size in zip(ends, sizes)]
+
     def _update_running_mean(self):
         """Update the state vector mean."""
-        diff = self.x_last - self.x_mean
-        self.x_mean = self.x_mean + diff / float(1.0 + self.niter)
+        np.subtract(self.x_last, self.x_mean, out=self.diff)
+        self.diff /= float(1.0 + self.niter)
+        self.x_mean += self.diff
 
     def _update_running_covariance(self):
         """Update the empirical covariance matrix."""
         if self.niter == 0:
             return
 
-        diff = self.x_last - self.x_mean
-        prod = np.outer(diff, diff) / float(self.niter + 1.0)
-        fact = float(self.niter - 1.0) / float(self.niter)
-        self.x_covariance = fact * self.x_covariance + prod
+        if self.low_rank_updates:
+            # Applied at the end of the block by _apply_block
+            np.subtract(self.x_last, self.x_mean,
+                        out=self.block[self.block_size])
+            self.block_niter[self.block_size] = self.niter
+            self.block_size += 1
+            return
+
+        np.subtract(self.x_last, self.x_mean, out=self.diff)
+        scale = float(self.niter - 1.0) / float(self.niter)
+        if self.structure == 'diagonal':
+            self.x_covariance *= scale
+            self.x_covariance += self.diff * self.diff / \
+                float(self.niter + 1.0)
+            return
+
+        if self.structure == 'blocks':
+            for block, x_covariance in zip(self.blocks, self.x_covariance):
+                diff = self.diff[block]
+                x_covariance *= scale
+                x_covariance += np.outer(diff, diff) / float(self.niter + 1.0)
+            return
+
+        np.outer(self.diff, self.diff, out=self.outer)
+        self.outer /= float(self.niter + 1.0)
+        self.x_covariance *= scale
+        self.x_covariance += self.outer
 
     def _update_covariance(self):
         """Update the covariance matrix used to generate candidate states."""
-        delta = self.sd * self.eps * np.identity(self.covariance.shape[0])
-        self.covariance = self.sd * self.x_covariance + delta
-        self.candidates = sample_gauss(self.covariance, self.update_freq)
+        if self.structure == 'diagonal':
+            self.covariance = self.sd * self.x_covariance + \
+                self.sd * self.eps
+        elif self.structure == 'blocks':
+            self.covariance = [
+                self.sd * x_covariance + self.sd * self.eps *
+                np.identity(x_covariance.shape[0])
+                for x_covariance in self.x_covariance]
+        else:
+            delta = self.sd * self.eps * \
+                np.identity(self.covariance.shape[0])
+            self.covariance = self.sd * self.x_covariance + delta
+        self.factor = self._factorize(self.covariance)
+
+        # Only a Cholesky factor can be updated with low-rank updates
+        if self.low_rank_updates and not np.any(np.triu(self.factor, 1)):
+            self.eps_factor = self.eps
+
+        # Candidates drawn from the old covariance are discarded
+        self.cursor = self.candidates.shape[0]
+
+    def _apply_block(self):
+        """
+        Apply the differences collected over a block to the covariance.
+
+        Over the steps n1, ..., n2 of the block the recursion of
+        _update_running_covariance multiplies the covariance by
+        (n1 - 1) / n2 and adds the difference of step n with the weight
+        n / ((n + 1) n2).
+
+        :return: the factor multiplying the old covariance and the weighted
+            differences, one per row
+        """
+        niters = self.block_niter[:self.block_size]
+        diffs = self.block[:self.block_size]
+        self.block_size = 0
+        if niters.shape[0] == 0:
+            return 1.0, diffs
+
+        scale = (niters[0] - 1.0) / niters[-1]
+        weights = niters / ((niters + 1.0) * niters[-1])
+        self.x_covariance *= scale
+        self.x_covariance += np.dot(diffs.T * weights, diffs)
+        return scale, diffs * np.sqrt(weights)[:, np.newaxis]
+
+    def _update_factor(self, scale, diffs):
+        """
+        Update the proposal with the differences collected over a block.
+
+        The old proposal covariance is scaled like the learnt covariance, so
+        that its regularization shrinks; the factor is computed again once
+        the regularization drops below half of eps.
+
+        :param scale: the factor multiplying the old covariance (float)
+        :param diffs: the weighted differences, one per row (numpy.ndarray)
+        """
+        if self.eps_factor is None or scale * self.eps_factor < 0.5 * self.eps:
+            self._update_covariance()
+            return
+
+        self.factor *= math.sqrt(scale)
+        cholesky_update(self.factor, math.sqrt(self.sd) * diffs.T)
+        self.eps_factor *= scale
+
+        identity = np.identity(self.covariance.shape[0])
+        self.covariance = self.sd * (self.x_covariance +
+                                     self.eps_factor * identity)
+        self.cursor = self.candidates.shape[0]
+
+    def set_gamma(self, gamma):
+        """
+        Change the scaling factor for the transitions step size.
+
+        The state of the chain and the learnt moments are kept; if the learnt
+        covariance matrix is already in use, the proposal is rebuilt at once.
+
+        :param gamma: scaling factor for the transitions step size (float)
+        """
+        self.sd = (2.7 ** 2) * gamma / float(self.x_last.shape[0])
+        if self.niter > self.t0:
+            self._update_covariance()
+
+    def set_state(self, x, log_prob=None):
+        """
+        Move the chain to a new state.
+
+        The learnt moments and the proposal are kept, so that the chain goes
+        on from the new state as if it had jumped there.
+
+        :param x: the new state (numpy.ndarray, must be a vector of valid
+            size)
+        :param log_prob: the logarithm of the density of the new state,
+            evaluated if not given (float)
+        """
+        checks.check_vector_validity(x)
+        checks.check_vector_size(x, self.x_last.shape[0])
+
+        self.x_last[:] = x
+        self.x_last_log_prob = self.posterior.log_prob(self.x_last) \
+            if log_prob is None else log_prob
+        self.speculated_to = 0
+
+    def _refill_candidates(self):
+        """Draw a new block of candidate steps from the proposal."""
+        self.normals[...] = self.random.standard_normal(self.normals.shape)
+        self.uniforms[...] = self.random.random_sample(self.uniforms.shape)
+        if self.structure == 'diagonal':
+            np.multiply(self.normals, self.factor, out=self.candidates)
+        elif self.structure == 'blocks':
+            for block, factor in zip(self.blocks, self.factor):
+                self.candidates[:, block] = np.dot(self.normals[:, block],
+                                                   factor.T)
+        else:
+            np.dot(self.normals, self.factor.T, out=self.candidates)
+        self.cursor = 0
+        self.speculated_to = 0
 
     def _generate_candidate(self):
         """Generate a new candidate state."""
-        if self.candidates is None or self.candidates.size == 0:
-            self.candidates = sample_gauss(self.covariance, self.update_freq)
+        if self.cursor == self.candidates.shape[0]:
+            self._refill_candidates()
+
+        np.add(self.x_last, self.candidates[self.cursor], out=self.x_candidate)
+        self.cursor += 1
+        return self.x_candidate
+
+    def _candidate_log_prob(self, x_candidate):
+        """
+        Evaluate the logarithm of the density of the last candidate.
 
-        candidate = self.x_last + self.candidates[0]
-        self.candidates = np.delete(self.candidates, 0, 0)
-        return candidate
+        With speculation, the candidate is evaluated on the pool together
+        with the next ones of the block, as offsets of the current state.
+
+        :param x_candidate: the candidate state (numpy.ndarray)
+        :return: the logarithm of the density of the candidate
+        """
+        if not self.speculate:
+            return self.posterior.log_prob(x_candidate)
+
+        index = self.cursor - 1
+        if not self.speculated_from <= index < self.speculated_to:
+            if self.pool is None:
+                self.pool = multiprocessing.pool.ThreadPool(self.speculate)
+                self.own_pool = True
+
+            end = min(index + self.speculate, self.candidates.shape[0])
+            states = self.x_last + self.candidates[index:end]
+            self.speculated[index:end] = self.pool.map(
+                _log_prob, [(self.posterior, x) for x in states])
+            self.speculated_from, self.speculated_to = index, end
+        return self.speculated[index]
+
+    def close(self):
+        """Stop the threads of the pool created for speculation, if any."""
+        if self.own_pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.own_pool = False
+
+    def _delayed_rejection(self, x_first_log_prob):
+        """
+        Try a second candidate after the first one has been rejected.
+
+        The second candidate is the next step of the proposal shrunk by
+        dr_scale; it is accepted with the probability that keeps the chain
+        reversible given the rejection of the first one. With z1 and z2 the
+        standard normals of the two candidates, the ratio of the proposal
+        densities of the first candidate reduces to
+        exp(-(|z1 - dr_scale z2|^2 - |z1|^2) / 2).
+
+        :param x_first_log_prob: logarithm of the density of the rejected
+            candidate (float)
+        :return: the logarithm of the density of the second candidate if it
+            is accepted, None otherwise
+        """
+        self.dr_first[:] = self.normals[self.cursor - 1]
+        if self.cursor == self.candidates.shape[0]:
+            self._refill_candidates()
+
+        np.multiply(self.candidates[self.cursor], self.dr_scale,
+                    out=self.x_candidate)
+        self.x_candidate += self.x_last
+        second = self.normals[self.cursor]
+        self.cursor += 1
+        self.dr_total += 1
+
+        x_second_log_prob = self.posterior.log_prob(self.x_candidate)
+        if x_second_log_prob == -np.inf or \
+                x_first_log_prob >= x_second_log_prob:
+            return None
+
+        # Probabilities of rejecting the first candidate from either state
+        with np.errstate(divide='ignore'):
+            log_ratio = x_second_log_prob - self.x_last_log_prob + \
+                np.log1p(-np.exp(x_first_log_prob - x_second_log_prob)) - \
+                np.log1p(-np.exp(x_first_log_prob - self.x_last_log_prob))
+        first_norm = np.dot(self.dr_first, self.dr_first)
+        self.dr_first -= self.dr_scale * second
+        log_ratio -= 0.5 * (np.dot(self.dr_first, self.dr_first) - first_norm)
+
+        cutoff = self.uniforms[self.cursor - 1]
+        if log_ratio >= 0.0 or cutoff <= math.exp(log_ratio):
+            self.dr_accepted += 1
+            return x_second_log_prob
+        return None
 
     def _step(self):
         """
         Implements a step of the Metropolis algorithm.
 
+        The acceptance test is carried out in log space so that densities
+        that underflow do not lead to 0 / 0 ratios.
+
         :return: True if the proposal state is accepted, False otherwise
         """
+        profile = self.profile
+        if profile is not None:
+            lap = profile.start()
+
         # Covariance depends on running mean and must be updated first
         self._update_running_covariance()
         self._update_running_mean()
+        if profile is not None:
+            lap = profile.lap('moments', lap)
 
         self.niter += 1
         x_candidate = self._generate_candidate()
-        x_candidate_probability = self.posterior.prob(x_candidate)
+        if profile is not None:
+            lap = profile.lap('proposal', lap)
 
-        cutoff = np.random.random()
-        ratio = x_candidate_probability / self.x_last_probability
+        x_candidate_log_prob = self._candidate_log_prob(x_candidate)
+        if profile is not None:
+            lap = profile.lap('posterior', lap)
 
-        if self.niter % self.update_freq == 0 and self.niter > self.t0:
-            self._update_covariance()
+        cutoff = self.uniforms[self.cursor - 1]
+        log_ratio = x_candidate_log_prob - self.x_last_log_prob
+
+        candidate_feasible = log_ratio >= 0.0 or cutoff <= math.exp(log_ratio)
+        if not candidate_feasible and self.dr_scale is not None:
+            x_second_log_prob = self._delayed_rejection(x_candidate_log_prob)
+            candidate_feasible = x_second_log_prob is not None
+            x_candidate_log_prob = x_second_log_prob
+            if profile is not None:
+                lap = profile.lap('posterior', lap)
 
-        candidate_feasible = ratio >= cutoff
         if candidate_feasible:
-            self.x_last = x_candidate
-            self.x_last_probability = x_candidate_probability
-            return True
+            # Swap the state buffers instead of copying the candidate
+            self.x_last, self.x_candidate = self.x_candidate, self.x_last
+            self.x_last_log_prob = x_candidate_log_prob
+            self.speculated_to = 0
+
+        # The proposal changes only once both candidates have been drawn
+        if self.niter % self.update_freq == 0:
+            if self.low_rank_updates:
+                scale, diffs = self._apply_block()
+                if self.niter > self.t0:
+                    self._update_factor(scale, diffs)
+            elif self.niter > self.t0:
+                self._update_covariance()
+            if profile is not None:
+                lap = profile.lap('adaptation', lap)
+
+        if profile is not None:
+            profile.record_step(candidate_feasible)
+        if self.step_callback is not None:
+            self.step_callback(self, candidate_feasible)
+        return candidate_feasible
+
+    def _advance(self, steps):
+        """
+        Advance the Markov chain by a number of steps.
 
-        return False
+        :param steps: the number of steps (int)
+        :return: the number of accepted jumps
+        """
+        jumps_accepted = 0
+        for _ in range(steps):
+            if self._step():
+                jumps_accepted += 1
+
+        self.jumps_accepted += jumps_accepted
+        self.jumps_total += steps
+        return jumps_accepted
 
     def sample(self, samples_number=1, sample_every=200):
         """
@@ -136,26 +712,238 @@ class MetroSampler:
         :param sample_every: the sampling frequency (int)
         :return: list of samples and numbers of accepted / attempted jumps
         """
-        jumps_total = 0
+        # Ensure sample frequency is at least one and no samples are
+        # generated for negative numbers
+        sample_every = sample_every if sample_every > 0 else 1
+        samples_number = max(samples_number, 0)
+
         jumps_accepted = 0
+        samples_list = np.empty((samples_number, self.x_last.shape[0]))
+        for i in range(samples_number):
+            jumps_accepted += self._advance(sample_every)
+            samples_list[i] = self.x_last
 
-        samples_list = np.array([])
-        samples_left = samples_number
+        return samples_list, jumps_accepted, samples_number * sample_every
+
+    def iter_samples(self, samples_number=1, sample_every=200,
+                     chunk_size=1000):
+        """
+        Generate samples from the distribution in blocks.
+
+        Each block is yielded as soon as it is filled, so that samples can be
+        consumed while the chain is still running. The numbers of accepted /
+        attempted jumps are accumulated in jumps_accepted and jumps_total.
 
-        # Ensure sample frequency is at least one
+        :param samples_number: the number of samples to generate (int)
+        :param sample_every: the sampling frequency (int)
+        :param chunk_size: the maximum number of samples per block (int)
+        :return: iterator over arrays of samples
+        """
+        # Ensure sample frequency and block size are at least one
         sample_every = sample_every if sample_every > 0 else 1
+        chunk_size = chunk_size if chunk_size > 0 else 1
+
+        samples_left = samples_number
         while samples_left > 0:
+            chunk = np.empty((min(chunk_size, samples_left),
+                              self.x_last.shape[0]))
+            for i in range(chunk.shape[0]):
+                self._advance(sample_every)
+                chunk[i] = self.x_last
 
-            for _ in range(sample_every):
-                success = self._step()
-                if success:
-                    jumps_accepted += 1
+            samples_left -= chunk.shape[0]
+            yield chunk
 
-                jumps_total += 1
+    def sample_until_ess(self, target_ess, max_lag=200, check_every=1000,
+                         max_steps=10000000):
+        """
+        Generate samples until their effective sample size reaches a target.
+
+        The autocorrelation of the chain is tracked online at every step and
+        the sampling frequency follows the integrated autocorrelation time
+        tau, which is estimated every check_every steps. The chain stops when
+        the steps run since the first estimate amount to target_ess times
+        tau, and the samples are finally thinned so that they are at least
+        tau steps apart. The tracker is kept in self.autocorrelation.
+
+        :param target_ess: the requested effective sample size (int)
+        :param max_lag: the largest lag of the tracked autocorrelation (int)
+        :param check_every: the number of steps between estimates of the
+            autocorrelation time (int)
+        :param max_steps: the maximum number of steps (int)
+        :return: list of samples and numbers of accepted / attempted jumps
+        """
+        tracker = diagnostics.AutocorrelationTracker(self.x_last.shape[0],
+                                                     max_lag)
+        self.autocorrelation = tracker
+        check_every = check_every if check_every > 0 else 1
+
+        samples_list = []
+        samples_steps = []
+        jumps_accepted = 0
+        jumps_total = 0
+
+        # Samples are only taken once a first estimate of tau is available
+        tau = None
+        next_sample = None
+        sampling_start = 0
+        while jumps_total < max_steps:
+            if self._step():
+                jumps_accepted += 1
+            jumps_total += 1
+            tracker.update(self.x_last)
+
+            if jumps_total == next_sample:
+                samples_list.append(self.x_last.copy())
+                samples_steps.append(jumps_total)
+                next_sample += int(math.ceil(tau))
+
+            if jumps_total % check_every == 0:
+                tau = float(np.max(tracker.integrated_time()))
+                if next_sample is None:
+                    sampling_start = jumps_total
+                    next_sample = jumps_total + 1
+                elif jumps_total - sampling_start >= target_ess * tau:
+                    break
+
+        self.jumps_accepted += jumps_accepted
+        self.jumps_total += jumps_total
+
+        # Keep samples at least tau steps apart with the final estimate
+        selected = []
+        for i, step in enumerate(samples_steps):
+            if not selected or step - samples_steps[selected[-1]] >= tau:
+                selected.append(i)
+
+        samples = np.empty((len(selected), self.x_last.shape[0]))
+        for i, index in enumerate(selected):
+            samples[i] = samples_list[index]
+        return samples, jumps_accepted, jumps_total
+
+    def save_checkpoint(self, fname, **extra):
+        """
+        Save the complete state of the sampler to a binary file.
+
+        The checkpoint stores the state of the Markov chain, the adapted
+        moments and proposal, the pending candidate steps and the state of
+        the random number generator; the distribution is not stored.
+        The file is replaced atomically, so an interrupted save leaves the
+        previous checkpoint intact.
 
-            samples_left -= 1
-            samples_list = np.append(samples_list, self.x_last)
+        :param fname: name of the checkpoint file (string)
+        :param extra: additional arrays to store with the checkpoint
+        """
+        _, rng_keys, rng_pos, rng_has_gauss, rng_gauss = \
+            self.random.get_state()
+        state = dict(extra)
+        state.update(x_last=self.x_last, x_last_log_prob=self.x_last_log_prob,
+                     x_mean=self.x_mean,
+                     x_covariance=self._pack(self.x_covariance),
+                     covariance=self._pack(self.covariance),
+                     factor=self._pack(self.factor), structure=self.structure,
+                     structure_index=np.concatenate(self.blocks) if
+                     self.blocks else np.empty(0, dtype=int),
+                     structure_sizes=[block.shape[0]
+                                      for block in self.blocks],
+                     candidates=self.candidates, normals=self.normals,
+                     uniforms=self.uniforms,
+                     cursor=self.cursor, dr_scale=np.nan if
+                     self.dr_scale is None else self.dr_scale,
+                     low_rank_updates=self.low_rank_updates,
+                     block=self.block if self.low_rank_updates else
+                     np.empty(0), block_niter=self.block_niter,
+                     block_size=self.block_size, eps_factor=np.nan if
+                     self.eps_factor is None else self.eps_factor,
+                     niter=self.niter, t0=self.t0, eps=self.eps, sd=self.sd,
+                     jumps_accepted=self.jumps_accepted,
+                     jumps_total=self.jumps_total, rng_keys=rng_keys,
+                     rng_pos=rng_pos, rng_has_gauss=rng_has_gauss,
+                     rng_gauss=rng_gauss)
+
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, **state)
+        os.rename(fname + '.tmp', fname)
+
+    def load_checkpoint(self, fname):
+        """
+        Restore the complete state of the sampler from a checkpoint file.
 
-        reshape_dims = (samples_number, self.x_last.shape[0])
-        samples_list = samples_list.reshape(reshape_dims)
-        return samples_list, jumps_accepted, jumps_total
+        :param fname: name of the checkpoint file (string)
+        :return: dictionary with the additional arrays stored with the
+            checkpoint
+        :raise: ValueError if the checkpoint dimension differs from the
+            dimension of the sampler
+        """
+        with np.load(fname) as data:
+            state = dict((key, data[key]) for key in data.files)
+
+        if state['x_last'].shape != self.x_last.shape:
+            raise ValueError('Error: checkpoint has incompatible dimensions')
+
+        self.x_last = state.pop('x_last')
+        self.x_last_log_prob = float(state.pop('x_last_log_prob'))
+        self.x_mean = state.pop('x_mean')
+        self.structure = str(state.pop('structure'))
+        index = state.pop('structure_index')
+        sizes = state.pop('structure_sizes')
+        self.blocks = np.split(index, np.cumsum(sizes)[:-1]) \
+            if sizes.shape[0] > 0 else []
+        self.x_covariance = self._unpack(state.pop('x_covariance'))
+        self.covariance = self._unpack(state.pop('covariance'))
+        self.factor = self._unpack(state.pop('factor'))
+        if self.structure == 'dense' and self.outer is None:
+            self.outer = np.empty(self.x_covariance.shape)
+        self.candidates = state.pop('candidates')
+        self.normals = state.pop('normals')
+        self.uniforms = state.pop('uniforms')
+        self.update_freq = self.candidates.shape[0]
+        self.cursor = int(state.pop('cursor'))
+        self.speculated = np.empty(self.update_freq)
+        self.speculated_to = 0
+        dr_scale = float(state.pop('dr_scale'))
+        self.dr_scale = None if np.isnan(dr_scale) else dr_scale
+        self.low_rank_updates = bool(state.pop('low_rank_updates'))
+        block = state.pop('block')
+        self.block = block if self.low_rank_updates else None
+        self.block_niter = state.pop('block_niter')
+        self.block_size = int(state.pop('block_size'))
+        eps_factor = float(state.pop('eps_factor'))
+        self.eps_factor = None if np.isnan(eps_factor) else eps_factor
+        self.niter = int(state.pop('niter'))
+        self.t0 = int(state.pop('t0'))
+        self.eps = float(state.pop('eps'))
+        self.sd = float(state.pop('sd'))
+        self.jumps_accepted = int(state.pop('jumps_accepted'))
+        self.jumps_total = int(state.pop('jumps_total'))
+
+        self.random.set_state(('MT19937', state.pop('rng_keys'),
+                               int(state.pop('rng_pos')),
+                               int(state.pop('rng_has_gauss')),
+                               float(state.pop('rng_gauss'))))
+        return state
+
+    @classmethod
+    def from_checkpoint(cls, posterior, fname, random_state=None):
+        """
+        Create a sampler from a checkpoint file without running the burnin.
+
+        :param posterior: distribution to sample from (posterior.Distribution)
+        :param fname: name of the checkpoint file (string)
+        :param random_state: the generator whose state is restored, see
+            make_random_state (numpy.random.RandomState)
+        :return: the restored sampler
+        """
+        with np.load(fname) as data:
+            x_last, covariance = data['x_last'], data['covariance']
+            dense = str(data['structure']) == 'dense'
+
+        # The structure is restored with the checkpoint, a diagonal proposal
+        # avoids building a dense matrix meanwhile
+        if dense:
+            sampler = cls(posterior, x_last, covariance, tb=0,
+                          random_state=random_state)
+        else:
+            sampler = cls(posterior, x_last, np.ones(x_last.shape[0]), tb=0,
+                          random_state=random_state, structure='diagonal')
+        sampler.load_checkpoint(fname)
+        return sampler
@@ -0,0 +1,329 @@
+import math
+import multiprocessing
+import numpy as np
+import sampler
+import posterior as post
+
+
+def geometric_betas(replicas=4, max_temperature=100.0):
+    """
+    Build a geometric ladder of inverse temperatures.
+
+    :param replicas: the number of replicas (int)
+    :param max_temperature: the temperature of the hottest replica (float)
+    :return: array of inverse temperatures, starting from 1
+    """
+    replicas = replicas if replicas > 0 else 1
+    return 1.0 / np.logspace(0.0, np.log10(max_temperature), replicas)
+
+
+class TemperedDistribution(post.Distribution):
+    """Define a distribution whose density is raised to a power beta."""
+
+    def __init__(self, posterior, beta):
+        """
+        Initialize the tempered distribution.
+
+        :param posterior: the distribution to temper (posterior.Distribution)
+        :param beta: the inverse temperature, between 0 and 1 (float)
+        """
+        self.posterior = posterior
+        self.beta = beta
+        self.ndim = getattr(posterior, 'ndim', None)
+
+    def get_example(self):
+        """Return a state vector with non-zero probability."""
+        return self.posterior.get_example()
+
+    def prob(self, x):
+        """Evaluate the tempered density of a state."""
+        return np.exp(self.log_prob(x))
+
+    def log_prob(self, x):
+        """Evaluate the logarithm of the tempered density of a state."""
+        log_prob = self.posterior.log_prob(x)
+        return log_prob if log_prob == -np.inf else self.beta * log_prob
+
+    def log_prob_batch(self, x_batch):
+        """Evaluate the logarithm of the tempered density of many states."""
+        log_probs = self.posterior.log_prob_batch(x_batch)
+        return np.where(log_probs == -np.inf, log_probs,
+                        self.beta * log_probs)
+
+
+def _make_replicas(posterior, x_initial, covariance_initial, betas, kwargs,
+                   seed):
+    """
+    Create and burn in one MetroSampler per inverse temperature, each with
+    its own random number generator seeded from seed.
+    """
+    seeds = sampler.spawn_seeds(seed, len(betas))
+    return [sampler.MetroSampler(TemperedDistribution(posterior, beta),
+                                 x_initial, covariance_initial,
+                                 random_state=seeds[i], **kwargs)
+            for i, beta in enumerate(betas)]
+
+
+def _handle(replicas, message):
+    """
+    Execute a command on a group of replicas.
+
+    ('advance', steps) advances every replica and returns its state, the
+    logarithm of its tempered density and its number of accepted jumps;
+    ('set_state', index, x, log_prob) moves a replica to a new state.
+    """
+    if message[0] == 'advance':
+        results = []
+        for replica in replicas:
+            accepted = replica._advance(message[1])
+            results.append((replica.x_last, replica.x_last_log_prob,
+                            accepted))
+        return results
+
+    if message[0] == 'set_state':
+        replicas[message[1]].set_state(message[2], message[3])
+    return None
+
+
+def _serve(connection, posterior, x_initial, covariance_initial, betas,
+           kwargs, seed):
+    """
+    Run a group of replicas in a worker process.
+
+    The replicas are created once and live as long as the process, which
+    executes the commands received on the connection until it is closed.
+    Exceptions are sent back to be raised in the calling process.
+    """
+    try:
+        replicas = _make_replicas(posterior, x_initial, covariance_initial,
+                                  betas, kwargs, seed)
+        connection.send(None)
+    except Exception as err:
+        connection.send(err)
+        return
+
+    while True:
+        message = connection.recv()
+        if message[0] == 'close':
+            break
+        try:
+            connection.send(_handle(replicas, message))
+        except Exception as err:
+            connection.send(err)
+    connection.close()
+
+
+class _LocalGroup:
+    """Group of replicas running in the calling process."""
+
+    def __init__(self, posterior, x_initial, covariance_initial, betas,
+                 kwargs, seed):
+        self.replicas = _make_replicas(posterior, x_initial,
+                                       covariance_initial, betas, kwargs,
+                                       seed)
+        self.reply = None
+
+    def send(self, message):
+        self.reply = _handle(self.replicas, message)
+
+    def recv(self):
+        return self.reply
+
+    def close(self):
+        pass
+
+
+class _RemoteGroup:
+    """Group of replicas running in a worker process."""
+
+    def __init__(self, posterior, x_initial, covariance_initial, betas,
+                 kwargs, seed):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_serve, args=(child, posterior, x_initial,
+                                 covariance_initial, betas, kwargs, seed))
+        self.process.daemon = True
+        self.process.start()
+
+    def send(self, message):
+        self.connection.send(message)
+
+    def recv(self):
+        reply = self.connection.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def close(self):
+        if self.process.is_alive():
+            self.connection.send(('close',))
+        self.process.join()
+        self.connection.close()
+
+
+class ReplicaExchangeSampler:
+    """
+    Generate samples from a multimodal distribution by parallel tempering.
+
+    A ladder of replicas samples the distribution raised to decreasing
+    powers beta, each with its own adaptive MetroSampler; hot replicas cross
+    between modes easily and pass their states down the ladder through
+    swaps of adjacent replicas. Samples are taken from the replica at beta
+    equal to 1. The details of the algorithm are described in the following
+    article:
+
+        - C. J. Geyer, Markov chain Monte Carlo maximum likelihood,
+          Computing Science and Statistics: Proceedings of the 23rd
+          Symposium on the Interface, 1991, pp. 156-163
+
+    Replicas are spread over worker processes that persist between calls
+    to sample; close must be called to stop them.
+    """
+
+    def __init__(self, posterior, x_initial, covariance_initial, betas=None,
+                 swap_every=100, workers=None, seed=None, **kwargs):
+        """
+        Initialize the sampler and burn in the replicas.
+
+        :param posterior: distribution to sample from (posterior.Distribution,
+            must be picklable)
+        :param x_initial: a state of the sampling distribution with nonzero
+            probability (numpy.ndarray, must be a vector)
+        :param covariance_initial: the initial covariance matrix used by the
+            proposal distribution of every replica (numpy.ndarray, must be a
+            square matrix)
+        :param betas: decreasing inverse temperatures of the replicas,
+            starting from 1; defaults to geometric_betas() (list of float)
+        :param swap_every: number of steps between swap attempts (int)
+        :param workers: the number of worker processes; defaults to the
+            smaller of the number of replicas and the number of CPUs, and
+            0 or 1 runs the replicas in the calling process (int)
+        :param seed: seed or generator used to generate the seeds of the
+            workers and of the swaps; defaults to NumPy's global generator
+            (int or numpy.random.RandomState)
+        :param kwargs: additional arguments passed to MetroSampler
+        :raise: ValueError if betas do not decrease from 1 to a positive
+            value
+        """
+        betas = geometric_betas() if betas is None else \
+            np.array(betas, dtype=float)
+        if betas[0] != 1.0 or np.any(np.diff(betas) >= 0.0) or \
+                betas[-1] <= 0.0:
+            raise ValueError('Error: inverse temperatures must decrease '
+                             'from 1 to a positive value')
+
+        replicas = betas.shape[0]
+        if workers is None:
+            workers = min(replicas, multiprocessing.cpu_count())
+        workers = min(max(workers, 1), replicas)
+
+        self.betas = betas
+        self.swap_every = swap_every if swap_every > 0 else 1
+        self.until_swap = self.swap_every
+        self.swap_phase = 0
+
+        # Replicas are dealt to the workers in turn
+        seeds = sampler.spawn_seeds(seed, workers + 1)
+        self.random = np.random.RandomState(seeds[-1])
+        self.location = [(i % workers, i // workers) for i in range(replicas)]
+        group_type = _LocalGroup if workers == 1 else _RemoteGroup
+        self.groups = []
+        try:
+            for k in range(workers):
+                self.groups.append(group_type(
+                    posterior, x_initial, covariance_initial,
+                    betas[k::workers], kwargs, seeds[k]))
+            for group in self.groups:
+                group.recv()
+        except Exception:
+            self.close()
+            raise
+
+        # States and untempered log densities of the replicas
+        self.states = np.tile(np.array(x_initial, dtype=float),
+                              (replicas, 1))
+        self.log_probs = np.zeros(replicas)
+
+        # Numbers of accepted / attempted jumps and swaps since burnin
+        self.jumps_accepted = np.zeros(replicas, dtype=int)
+        self.jumps_total = np.zeros(replicas, dtype=int)
+        self.swaps_accepted = np.zeros(replicas - 1, dtype=int)
+        self.swaps_total = np.zeros(replicas - 1, dtype=int)
+
+    def _advance(self, steps):
+        """
+        Advance all replicas by a number of steps, in parallel.
+
+        :param steps: the number of steps (int)
+        """
+        for group in self.groups:
+            group.send(('advance', steps))
+        replies = [group.recv() for group in self.groups]
+
+        for i, (k, index) in enumerate(self.location):
+            x, log_prob, accepted = replies[k][index]
+            self.states[i] = x
+            self.log_probs[i] = log_prob / self.betas[i]
+            self.jumps_accepted[i] += accepted
+            self.jumps_total[i] += steps
+
+    def _swap(self):
+        """
+        Attempt swaps between adjacent replicas.
+
+        Even and odd pairs of replicas are tried in turn, so that the pairs
+        tried together are disjoint.
+        """
+        moved = []
+        for i in range(self.swap_phase, self.betas.shape[0] - 1, 2):
+            log_ratio = (self.betas[i] - self.betas[i + 1]) * \
+                (self.log_probs[i + 1] - self.log_probs[i])
+            self.swaps_total[i] += 1
+            if log_ratio >= 0.0 or \
+                    self.random.random_sample() <= math.exp(log_ratio):
+                self.states[[i, i + 1]] = self.states[[i + 1, i]]
+                self.log_probs[[i, i + 1]] = self.log_probs[[i + 1, i]]
+                self.swaps_accepted[i] += 1
+                moved.extend([i, i + 1])
+        self.swap_phase = 1 - self.swap_phase
+
+        for i in moved:
+            k, index = self.location[i]
+            self.groups[k].send(('set_state', index, self.states[i],
+                                 self.betas[i] * self.log_probs[i]))
+            self.groups[k].recv()
+
+    def sample(self, samples_number=1, sample_every=200):
+        """
+        Generate samples from the distribution.
+
+        :param samples_number: the number of samples to generate (int)
+        :param sample_every: the sampling frequency (int)
+        :return: list of samples and numbers of accepted / attempted jumps
+            of the replica at beta equal to 1
+        """
+        # Ensure sample frequency is at least one
+        sample_every = sample_every if sample_every > 0 else 1
+
+        jumps_accepted = self.jumps_accepted[0]
+        samples_list = np.empty((samples_number, self.states.shape[1]))
+        for i in range(samples_number):
+            remaining = sample_every
+            while remaining > 0:
+                steps = min(remaining, self.until_swap)
+                self._advance(steps)
+                remaining -= steps
+                self.until_swap -= steps
+                if self.until_swap == 0:
+                    self._swap()
+                    self.until_swap = self.swap_every
+            samples_list[i] = self.states[0]
+
+        jumps_accepted = self.jumps_accepted[0] - jumps_accepted
+        return samples_list, jumps_accepted, samples_number * sample_every
+
+    def close(self):
+        """Stop the worker processes."""
+        for group in self.groups:
+            group.close()
+        self.groups = []
@@ -1,4 +1,5 @@
 import numpy as np
+import metrosampler.posterior as pr
 
 
 class MockedConstraints:
@@ -15,4 +16,23 @@ class MockedConstraints:
         return self.example
 
     def apply(self, x):
-        return True
\ No newline at end of file
+        return True
+
+    def apply_batch(self, x_batch):
+        return np.ones(x_batch.shape[0], dtype=bool)
+
+
+class MockedGaussian(pr.Distribution):
+    """Standard Gaussian whose density underflows away from the mode."""
+
+    def __init__(self, ndim):
+        self.ndim = ndim
+
+    def get_example(self):
+        return 6.0 * np.ones(self.ndim)
+
+    def prob(self, x):
+        return np.exp(self.log_prob(x))
+
+    def log_prob(self, x):
+        return -0.5 * np.dot(x, x)
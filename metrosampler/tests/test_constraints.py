@@ -0,0 +1,207 @@
+import pickle
+import pytest
+import numpy as np
+import metrosampler.constraints as cs
+
+
+class TestConstraint(object):
+
+    def test_linear_model(self):
+        """Verify that the alloy constraints are compiled to a matrix."""
+        constraints = cs.Constraint('metrosampler/tests/Data/alloy.txt',
+                                    presolve=False)
+
+        assert constraints.coefficients.shape == (24, 11)
+        assert constraints.offsets.shape == (24,)
+        assert len(constraints.exprs) == 0
+
+        # x[0] - 0.0004 >= 0.0 and 0.0035 - x[0] >= 0.0
+        assert constraints.coefficients[2, 0] == 1.0
+        assert abs(constraints.offsets[2] - 0.0004) <= 1.0e-12
+        assert constraints.coefficients[3, 0] == -1.0
+        assert abs(constraints.offsets[3] + 0.0035) <= 1.0e-12
+
+    def test_presolve(self, tmpdir):
+        """Verify that bounds are extracted and redundant rows dropped."""
+        constraints = cs.Constraint('metrosampler/tests/Data/alloy.txt')
+
+        # Only the two bounds on the sum of the coordinates are left
+        assert constraints.coefficients.shape == (2, 11)
+        assert list(constraints.row_index) == [0, 1]
+        lower, upper = constraints.get_bounds()
+        assert abs(lower[0] - 0.0004) <= 1.0e-12
+        assert abs(upper[0] - 0.0035) <= 1.0e-12
+
+        fname = tmpdir.join('box.txt')
+        fname.write('2\n0.2 0.2\n'
+                    'x[0] >= 0.1\n'
+                    'x[0] >= 0.05\n'
+                    '2 * x[1] <= 0.8\n'
+                    'x[0] + x[1] <= 1.5\n'
+                    'x[0] + x[1] >= 0.3\n'
+                    'x[0] - x[1] <= 0.6\n'
+                    '2 * x[0] - x[1] <= 2.0\n')
+        constraints = cs.Constraint(str(fname))
+        lower, upper = constraints.get_bounds()
+
+        assert np.allclose(lower, [0.1, -np.inf])
+        assert np.allclose(upper, [np.inf, 0.4])
+        assert list(constraints.row_index) == [4, 5]
+        assert constraints.apply([0.2, 0.2])
+        assert not constraints.apply([0.05, 0.3])
+        assert not constraints.apply([0.1, 0.1])
+
+    def test_linear_model_matches_eval(self):
+        """Verify that the matrix model agrees with the source expressions."""
+        fname = 'metrosampler/tests/Data/alloy.txt'
+        constraints = cs.Constraint(fname)
+        with open(fname, 'r') as f:
+            lines = [l for l in f.readlines()[2:] if l[0] != '#']
+
+        np.random.seed(0)
+        x0 = np.array(constraints.get_example())
+        for _ in range(500):
+            x = (x0 + 0.01 * np.random.standard_normal(x0.shape)).tolist()
+            expected = True
+            for line in lines:
+                expected = expected and eval(line)
+            assert constraints.apply(x) == expected
+
+    def test_integer_division(self, tmpdir):
+        """Verify that quotients of integers keep integer division."""
+        fname = tmpdir.join('division.txt')
+        fname.write('2\n0.5 0.5\n'
+                    '1/2*x[0] + 0.1 <= 0.3\n'
+                    'x[1] / 2 <= 0.3\n')
+        constraints = cs.Constraint(str(fname), presolve=False)
+
+        assert constraints.coefficients.shape == (1, 2)
+        assert len(constraints.exprs) == 1
+        assert constraints.apply([0.9, 0.5])
+        assert not constraints.apply([0.9, 0.7])
+
+    def test_nonlinear_fallback(self, tmpdir):
+        """Verify that nonlinear constraints are evaluated as expressions."""
+        fname = tmpdir.join('circle.txt')
+        fname.write('2\n0.5 0.5\n'
+                    '2 * x[0] + x[1] / 4 <= 1.0\n'
+                    'x[0] * x[0] + x[1] * x[1] <= 0.5\n'
+                    'x[1] > 0.1\n')
+        constraints = cs.Constraint(str(fname))
+
+        assert constraints.coefficients.shape == (1, 2)
+        assert len(constraints.exprs) == 2
+
+        assert constraints.apply([0.3, 0.3])
+        assert not constraints.apply([0.48, 0.3])
+        assert not constraints.apply([0.1, 0.8])
+        assert not constraints.apply([0.1, 0.1])
+
+    def test_pickle(self, tmpdir):
+        """Verify that constraints survive a pickling round trip."""
+        fname = tmpdir.join('circle.txt')
+        fname.write('2\n0.5 0.5\n'
+                    'x[0] * x[0] + x[1] * x[1] <= 0.5\n')
+        constraints = pickle.loads(pickle.dumps(cs.Constraint(str(fname))))
+
+        assert constraints.apply([0.3, 0.3])
+        assert not constraints.apply([0.1, 0.8])
+
+    def test_long_linear_sum(self, tmpdir):
+        """Verify that sums longer than the recursion limit are linear."""
+        ndim = 1500
+        fname = tmpdir.join('sum.txt')
+        fname.write('%d\n%s\n1.0 - %s >= 0.0\n' % (
+            ndim, ' '.join(['0.0'] * ndim),
+            ' - '.join('x[%d]' % i for i in range(ndim))))
+        constraints = cs.Constraint(str(fname))
+
+        assert constraints.coefficients.shape == (1, ndim)
+        assert np.all(constraints.coefficients == -1.0)
+        assert constraints.apply(np.zeros(ndim))
+        assert not constraints.apply(np.ones(ndim))
+
+    def test_track_rejections(self, tmpdir):
+        """Verify that the rejections of each constraint are counted."""
+        fname = tmpdir.join('circle.txt')
+        fname.write('2\n0.5 0.5\n'
+                    'x[0] <= 0.5\n'
+                    'x[1] <= 0.5\n'
+                    'x[0] * x[0] + x[1] * x[1] <= 0.2\n')
+        constraints = cs.Constraint(str(fname))
+        constraints.track_rejections()
+
+        constraints.apply([0.6, 0.6])
+        constraints.apply([0.6, 0.1])
+        constraints.apply([0.4, 0.4])
+        constraints.apply_batch(np.array([[0.1, 0.7], [0.1, 0.1]]))
+
+        counts = [count for _, count in constraints.get_rejections()]
+        assert counts == [2, 2, 1]
+
+    def test_adaptive_order(self, tmpdir):
+        """Verify that the most selective constraints are evaluated first."""
+        fname = tmpdir.join('order.txt')
+        fname.write('2\n0.1 0.1\n'
+                    'x[0] * x[1] <= 0.9\n'
+                    'x[0] * x[0] <= 0.5\n'
+                    'x[1] * x[1] <= 0.04\n')
+        constraints = cs.Constraint(str(fname), reorder_every=100)
+        assert constraints.get_order() == [0, 1, 2]
+
+        np.random.seed(0)
+        x = np.random.random((1000, 2))
+        expected = [constraints.apply(val) for val in x]
+        assert constraints.get_order() == [2, 1, 0]
+        assert [constraints.apply(val) for val in x] == expected
+
+        # The order survives pickling and can be set on new constraints
+        copy = pickle.loads(pickle.dumps(constraints))
+        assert copy.get_order() == [2, 1, 0]
+        other = cs.Constraint(str(fname), reorder_every=0)
+        other.set_order(constraints.get_order())
+        assert other.get_order() == [2, 1, 0]
+        assert np.array_equal(other.apply_batch(x), expected)
+
+        with pytest.raises(ValueError):
+            other.set_order([0, 0, 1])
+
+    def test_cache(self, tmpdir, monkeypatch):
+        """Verify that analyzed models are cached by content."""
+        fname = tmpdir.join('circle.txt')
+        fname.write('2\n0.3 0.3\n'
+                    'x[0] >= 0.1\n'
+                    'x[0] + x[1] <= 1.0\n'
+                    'x[0] * x[0] + x[1] * x[1] <= 0.5\n')
+        cache_dir = str(tmpdir.join('cache'))
+        constraints = cs.Constraint(str(fname), cache_dir=cache_dir)
+        assert len(tmpdir.join('cache').listdir()) == 1
+
+        # A second load reads the cache without analyzing the file
+        def analyze(self, lines, presolve):
+            raise AssertionError('the model should come from the cache')
+        with monkeypatch.context() as patch:
+            patch.setattr(cs.Constraint, '_analyze', analyze)
+            cached = cs.Constraint(str(fname), cache_dir=cache_dir)
+
+        assert cached.n_dim == 2 and cached.example == [0.3, 0.3]
+        assert cached.linear_sources == constraints.linear_sources
+        assert cached.expr_sources == constraints.expr_sources
+        assert np.array_equal(cached.coefficients, constraints.coefficients)
+        assert np.array_equal(cached.lower, constraints.lower)
+        assert np.array_equal(cached.row_index, constraints.row_index)
+        for x in [[0.3, 0.3], [0.05, 0.3], [0.6, 0.6], [0.9, 0.05]]:
+            assert cached.apply(x) == constraints.apply(x)
+
+        # A changed file gets a new entry, a damaged entry is replaced
+        fname.write('2\n0.3 0.3\nx[0] >= 0.2\n')
+        changed = cs.Constraint(str(fname), cache_dir=cache_dir)
+        assert changed.lower[0] == 0.2
+        assert len(tmpdir.join('cache').listdir()) == 2
+
+        for entry in tmpdir.join('cache').listdir():
+            entry.write('damaged')
+        changed = cs.Constraint(str(fname), cache_dir=cache_dir)
+        assert changed.lower[0] == 0.2
+        assert not cs.Constraint(str(fname), cache_dir=cache_dir).apply(
+            [0.1, 0.3])
@@ -0,0 +1,48 @@
+import numpy as np
+import metrosampler.diagnostics as dg
+
+
+def autoregressive_chain(phi, nlen, ndim, seed=0):
+    """Generate an AR(1) chain, whose integrated time is (1+phi)/(1-phi)."""
+    rng = np.random.RandomState(seed)
+    chain = np.empty((nlen, ndim))
+    chain[0] = rng.standard_normal(ndim)
+    for i in range(1, nlen):
+        chain[i] = phi * chain[i - 1] + rng.standard_normal(ndim)
+    return 1.0 + chain
+
+
+class TestDiagnostics(object):
+
+    def test_integrated_time(self):
+        """Check the estimate on a chain with known autocorrelation time."""
+        chain = autoregressive_chain(0.5, 50000, 2)
+        times = dg.integrated_time(chain, 200)
+
+        assert np.all(np.abs(times - 3.0) < 0.3)
+
+    def test_tracker_autocovariance(self):
+        """Check the online autocovariance against a direct computation."""
+        chain = autoregressive_chain(0.8, 2000, 3)
+        tracker = dg.AutocorrelationTracker(3, 10)
+        for val in chain:
+            tracker.update(val)
+
+        # The tracker works on states shifted by the first one
+        shifted = chain - chain[0]
+        mean = np.mean(shifted, 0)
+        acov = tracker.autocovariance()
+        for lag in range(10):
+            prod = shifted[lag:] * shifted[:chain.shape[0] - lag]
+            expected = np.mean(prod, 0) - mean * mean
+            assert np.allclose(acov[lag], expected, atol=1.0e-10)
+
+    def test_tracker_effective_sample_size(self):
+        """Check the online estimate on a chain with known time."""
+        chain = autoregressive_chain(0.5, 50000, 2)
+        tracker = dg.AutocorrelationTracker(2, 100)
+        for val in chain:
+            tracker.update(val)
+
+        assert np.all(np.abs(tracker.integrated_time() - 3.0) < 0.3)
+        assert abs(tracker.effective_sample_size() - 50000 / 3.0) < 2000.0
@@ -0,0 +1,63 @@
+import numpy as np
+import helpers as hs
+import metrosampler.ensemble as en
+import metrosampler.posterior as pr
+import metrosampler.constraints as cs
+
+
+class TestEnsemble(object):
+
+    def test_running_moments(self):
+        """Check the moments of each chain and of the pooled ensemble."""
+        distribution = hs.MockedGaussian(3)
+        x = np.zeros(3)
+        cov = np.identity(3)
+
+        for pooled in [False, True]:
+            np.random.seed(0)
+            sampler = en.EnsembleSampler(distribution, x, cov, 4, 20, 10 ** 9,
+                                         0, pooled=pooled)
+            states = []
+            for _ in range(50):
+                states.append(sampler.x_last.copy())
+                sampler._step()
+            states = np.array(states)
+
+            if pooled:
+                pooled_states = states.reshape(-1, 3)
+                assert np.allclose(sampler.x_mean[0], pooled_states.mean(0))
+                assert np.allclose(sampler.x_covariance[0],
+                                   np.cov(pooled_states.T))
+            else:
+                assert np.allclose(sampler.x_mean, states.mean(0))
+
+    def test_gaussian_moments(self):
+        """Check the samples of all chains follow the distribution."""
+        distribution = hs.MockedGaussian(2)
+        for pooled in [False, True]:
+            np.random.seed(0)
+            sampler = en.EnsembleSampler(distribution, np.zeros(2),
+                                         np.identity(2), 20, 100, 500, 1000,
+                                         pooled=pooled)
+            samples, accepted, total = sampler.sample(10000, 5)
+
+            assert samples.shape == (10000, 2)
+            assert accepted.shape == total.shape == (20,)
+            assert np.all(total == 2500) and np.all(accepted > 0)
+            assert np.all(np.abs(np.mean(samples, 0)) < 0.1)
+            assert np.all(np.abs(np.var(samples, 0) - 1.0) < 0.1)
+
+    def test_samples_are_feasible(self):
+        """Check the ensemble only visits feasible states."""
+        constraints = cs.Constraint('metrosampler/tests/Data/alloy.txt')
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        x = distribution.get_example()
+        cov = 1.0e-6 * np.identity(x.shape[0])
+        sampler = en.EnsembleSampler(distribution, x, cov, 16, 50, 100, 200,
+                                     0.1)
+        samples, accepted, total = sampler.sample(100, 5)
+
+        assert samples.shape == (100, x.shape[0])
+        assert np.all(distribution.prob_batch(samples) == 1.0)
+        assert np.all(sampler.jumps_total == 35)
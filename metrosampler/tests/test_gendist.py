@@ -0,0 +1,28 @@
+import sys
+import pytest
+import numpy as np
+import scripts.gendist as gd
+
+
+class TestGendist(object):
+
+    @pytest.mark.parametrize('method', ['metropolis', 'hitandrun',
+                                        'ensemble'])
+    def test_batch(self, tmpdir, monkeypatch, method):
+        """Verify that a batch writes the samples and the summary."""
+        tmpdir.join('box.txt').write('2\n0.5 0.5\n'
+                                     'x[0] + x[1] <= 1.2\n'
+                                     'x[0] >= 0.2\n')
+        outdir = tmpdir.join('out')
+        monkeypatch.setattr(sys, 'argv', [
+            'gendist', str(tmpdir), str(outdir), '20', '--batch',
+            '--workers', '1', '--method', method, '--seed', '1'])
+        gd.gendist()
+
+        samples = np.loadtxt(str(outdir.join('box.txt')))
+        assert samples.shape == (20, 2)
+        assert np.all(samples[:, 0] >= 0.2)
+
+        summary = outdir.join('summary.txt').read().splitlines()
+        assert len(summary) == 2
+        assert summary[1].split()[-1] == 'ok'
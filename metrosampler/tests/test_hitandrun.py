@@ -0,0 +1,49 @@
+import pytest
+import numpy as np
+import metrosampler.hitandrun as hr
+import metrosampler.posterior as pr
+import metrosampler.constraints as cs
+
+
+class TestHitAndRun(object):
+
+    def test_samples_are_feasible(self):
+        """Verify that all samples of the alloy polytope are feasible."""
+        constraints = cs.Constraint('metrosampler/tests/Data/alloy.txt')
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        for coordinate in [False, True]:
+            sampler = hr.HitAndRunSampler(distribution, tb=200,
+                                          coordinate=coordinate)
+            samples, accepted, total = sampler.sample(200, 5)
+
+            assert accepted == total == 1000
+            assert np.all(distribution.prob_batch(samples) == 1.0)
+
+        # The same in the space rescaled to the bounding box
+        rescaled = pr.ConstrainedDistribution(constraints, rescale=True)
+        samples, _, _ = hr.HitAndRunSampler(rescaled, tb=200).sample(200, 5)
+        assert np.all(rescaled.prob_batch(samples) == 1.0)
+        assert np.all(distribution.prob_batch(
+            rescaled.to_original(samples)) == 1.0)
+
+    def test_uniform_on_triangle(self):
+        """Verify the sample mean of the uniform distribution on a triangle."""
+        constraints = cs.Constraint('metrosampler/examples/Data/mixture.txt')
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        np.random.seed(0)
+        sampler = hr.HitAndRunSampler(distribution, np.array([.2, .2]), 100)
+        samples, _, _ = sampler.sample(5000, 3)
+
+        # The centroid of the triangle is (1/3, 1/3)
+        assert np.all(np.abs(np.mean(samples, 0) - 1.0 / 3.0) < 0.02)
+
+    def test_nonlinear_constraints(self, tmpdir):
+        """Verify that nonlinear constraints are rejected."""
+        fname = tmpdir.join('circle.txt')
+        fname.write('2\n0.5 0.5\nx[0] * x[0] + x[1] * x[1] <= 0.5\n')
+        distribution = pr.ConstrainedDistribution(cs.Constraint(str(fname)))
+
+        with pytest.raises(ValueError):
+            hr.HitAndRunSampler(distribution)
@@ -0,0 +1,66 @@
+import pytest
+import numpy as np
+import metrosampler.output as out
+
+
+class TestOutput(object):
+
+    def test_text_roundtrip(self, tmpdir):
+        """Verify that text output is appended and truncated on resume."""
+        fname = str(tmpdir.join('samples.txt'))
+        samples = np.random.random((6, 3))
+
+        writer = out.open_writer(fname, 'txt', 3, 6)
+        writer.write(samples[:2])
+        position = writer.position()
+        writer.write(samples[2:4])
+        writer.close()
+
+        # Samples written after the position are dropped
+        assert position == 2
+        writer = out.open_writer(fname, 'txt', 3, 6, position=position)
+        assert writer.position() == 2
+        writer.write(samples[2:])
+        writer.close()
+
+        loaded, metadata = out.load_samples(fname)
+        assert metadata is None
+        assert np.allclose(loaded, samples, rtol=1.0e-4)
+
+    def test_npy_roundtrip(self, tmpdir):
+        """Verify that binary output is memory-mapped and resumed."""
+        fname = str(tmpdir.join('samples.npy'))
+        samples = np.random.random((6, 3))
+
+        writer = out.open_writer(fname, 'npy', 3, 6, np.float32)
+        writer.write(samples[:4])
+        writer.flush()
+        assert writer.position() == 4
+        writer.close()
+
+        writer = out.open_writer(fname, 'npy', 3, 6, np.float32, 2)
+        assert writer.position() == 2
+        writer.write(samples[2:])
+        writer.close()
+
+        out.save_metadata(fname, ndim=3, samples=6, gamma=0.5, seed=7)
+        loaded, metadata = out.load_samples(fname)
+        assert isinstance(loaded, np.memmap)
+        assert loaded.dtype == np.float32
+        assert np.allclose(loaded, samples, rtol=1.0e-6)
+        assert metadata == dict(ndim=3, samples=6, gamma=0.5, seed=7)
+
+        # A file of another shape is replaced by a new one
+        writer = out.open_writer(fname, 'npy', 3, 8, np.float32, 6)
+        assert writer.position() == 0
+        writer.close()
+
+        # Binary files are recognized whatever their name
+        other = str(tmpdir.join('samples.txt'))
+        writer = out.open_writer(other, 'npy', 3, 6)
+        writer.write(samples)
+        writer.close()
+        assert np.array_equal(out.load_samples(other)[0], samples)
+
+        with pytest.raises(ValueError):
+            out.open_writer(fname, 'csv', 3, 6)
@@ -0,0 +1,55 @@
+import numpy as np
+import metrosampler.parallel as pl
+import metrosampler.posterior as pr
+import metrosampler.constraints as cs
+
+
+class TestParallel(object):
+
+    def test_sample_chains(self):
+        """Verify that the samples of all chains are merged and feasible."""
+        constraints = cs.Constraint('metrosampler/tests/Data/alloy.txt')
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        x = distribution.get_example()
+        cov = 1.0e-6 * np.identity(x.shape[0])
+        samples, accepted, total = pl.sample_chains(
+            distribution, x, cov, 50, 10, chains=3, workers=2, seed=1,
+            t0=100, tb=200)
+
+        assert samples.shape == (50, x.shape[0])
+        assert accepted.shape == (3,)
+        assert list(total) == [170, 170, 160]
+        for val in samples:
+            assert distribution.prob(val) == 1.0
+
+    def test_sample_chains_reproducible(self):
+        """Verify that chains with the same seed generate the same samples."""
+        constraints = cs.Constraint('metrosampler/tests/Data/alloy.txt')
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        x = distribution.get_example()
+        cov = 1.0e-6 * np.identity(x.shape[0])
+        serial, _, _ = pl.sample_chains(distribution, x, cov, 20, 5, chains=2,
+                                        workers=1, seed=3, tb=50)
+        parallel, _, _ = pl.sample_chains(distribution, x, cov, 20, 5,
+                                          chains=2, workers=2, seed=3, tb=50)
+
+        assert np.array_equal(serial, parallel)
+
+    def test_evaluate_gammas(self):
+        """Verify that larger step sizes lead to fewer accepted jumps."""
+        constraints = cs.Constraint('metrosampler/tests/Data/alloy.txt')
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        x = distribution.get_example()
+        cov = 1.0e-6 * np.identity(x.shape[0])
+        ratios, chains = pl.evaluate_gammas(distribution, x, cov,
+                                            [1.0e-4, 10.0], 200, 5, workers=2,
+                                            seed=1, t0=100, tb=200)
+
+        assert ratios.shape == (2,)
+        assert ratios[0] > ratios[1]
+        assert len(chains) == 2
+        assert abs(chains[1].sd / chains[0].sd - 1.0e5) <= 1.0e-5
+        assert distribution.prob(chains[0].x_last) == 1.0
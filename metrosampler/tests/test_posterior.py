@@ -3,6 +3,7 @@ import numpy as np
 import helpers as hp
 import metrosampler.posterior as sp
 import metrosampler.constraints as cs
+import metrosampler.sampler as sr
 
 
 class TestPosterior(object):
@@ -53,3 +54,78 @@ class TestPosterior(object):
         for i in range(x.shape[0]):
             valid = constraints.apply(x[i,:].T)
             assert valid
+
+    def test_prob_batch(self):
+        """Test prob_batch method with feasible and unfeasible states."""
+        constraints = hp.MockedConstraints()
+        distribution = sp.ConstrainedDistribution(constraints)
+
+        x = np.array([[.2, .9], [1.2, .2], [.5, -.1], [0., 1.]])
+        valid = distribution.prob_batch(x)
+
+        assert np.allclose(valid, [1., 0., 0., 1.])
+
+    def test_prob_batch_invalid_x(self):
+        """Test prob_batch method with states of incompatible size."""
+        constraints = hp.MockedConstraints()
+        distribution = sp.ConstrainedDistribution(constraints)
+
+        x = np.array([[.1, .1, .1]])
+        with pytest.raises(ValueError):
+            distribution.prob_batch(x)
+
+    def test_prob_batch_matches_prob(self):
+        """Verify that batched and single evaluations agree."""
+        constraints = cs.Constraint('metrosampler/tests/Data/alloy.txt')
+        distribution = sp.ConstrainedDistribution(constraints)
+
+        np.random.seed(0)
+        x0 = distribution.get_example()
+        x = x0 + 0.005 * np.random.standard_normal((500, x0.shape[0]))
+
+        expected = [distribution.prob(val) for val in x]
+        assert np.array_equal(distribution.prob_batch(x), expected)
+        assert np.array_equal(
+            sp.Distribution.prob_batch(distribution, x), expected)
+
+    def test_rescale(self):
+        """Verify that the rescaled distribution maps onto the bounding box."""
+        constraints = cs.Constraint('metrosampler/tests/Data/alloy.txt')
+        distribution = sp.ConstrainedDistribution(constraints)
+        rescaled = sp.ConstrainedDistribution(constraints, rescale=True)
+
+        x0 = rescaled.get_example()
+        assert np.all((x0 >= 0.0) & (x0 <= 1.0))
+        assert np.allclose(rescaled.to_original(x0),
+                           distribution.get_example())
+
+        np.random.seed(0)
+        u = x0 + 0.05 * np.random.standard_normal((500, x0.shape[0]))
+        expected = distribution.prob_batch(rescaled.to_original(u))
+        assert np.array_equal(rescaled.prob_batch(u), expected)
+        assert np.array_equal([rescaled.prob(val) for val in u], expected)
+
+    def test_bound_rejections_are_counted(self, tmpdir):
+        """Verify that rejected steps are charged to the violated bounds."""
+        fname = tmpdir.join('box.txt')
+        fname.write('2\n0.5 0.5\n'
+                    'x[0] >= 0.3\n'
+                    'x[0] <= 0.7\n'
+                    'x[1] >= 0.3\n'
+                    'x[1] <= 0.7\n')
+        constraints = cs.Constraint(str(fname))
+        assert constraints.coefficients.shape[0] == 0
+
+        for rescale in [False, True]:
+            constraints.track_rejections()
+            distribution = sp.ConstrainedDistribution(constraints, rescale)
+            x0 = distribution.get_example()
+            sampler = sr.MetroSampler(distribution, x0, 0.01 * np.identity(2),
+                                      200, 10 ** 9, 0, random_state=1)
+            _, accepted, total = sampler.sample(200, 10)
+
+            # Every rejection violates at least one bound, inside [0, 1]
+            counts = [count for _, count in constraints.get_rejections()]
+            assert total - accepted > 0
+            assert sum(counts) >= total - accepted
+            assert all(count > 0 for count in counts)
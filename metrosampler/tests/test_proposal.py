@@ -16,3 +16,28 @@ class TestProposal(object):
 
         assert abs(samples_mean[0] - 0.) < 1.0e-1
         assert abs(samples_mean[1] - 0.) < 1.0e-1
+
+    def test_factorize_covariance(self):
+        """Verify the factorization of definite and singular covariances."""
+        covariance = np.array([[2.0, 0.5], [0.5, 1.0]])
+        factor = sr.factorize_covariance(covariance)
+        assert np.allclose(np.dot(factor, factor.T), covariance)
+        assert factor[0, 1] == 0.0
+
+        covariance = np.array([[1.0, 1.0], [1.0, 1.0]])
+        factor = sr.factorize_covariance(covariance)
+        assert np.allclose(np.dot(factor, factor.T), covariance)
+
+    def test_cholesky_update(self):
+        """Verify the rank-k update of a Cholesky factor."""
+        np.random.seed(0)
+        for ndim, rank, block_size in [(5, 3, 2), (50, 7, 8), (130, 20, 64)]:
+            matrix = np.random.standard_normal((ndim, ndim))
+            covariance = np.dot(matrix, matrix.T) + np.identity(ndim)
+            vectors = np.random.standard_normal((ndim, rank))
+
+            factor = np.linalg.cholesky(covariance)
+            sr.cholesky_update(factor, vectors, block_size)
+            expected = np.linalg.cholesky(covariance +
+                                          np.dot(vectors, vectors.T))
+            assert np.allclose(factor, expected)
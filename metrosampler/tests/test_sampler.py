@@ -1,7 +1,10 @@
+import pytest
 import numpy as np
 import helpers as hs
 import metrosampler.sampler as sr
 import metrosampler.posterior as pr
+import metrosampler.constraints as cs
+import metrosampler.profiling as pf
 
 
 class TestSampler(object):
@@ -77,3 +80,309 @@ class TestSampler(object):
         assert (abs(covariance[1, 0] - sampler.covariance[1, 0])) <= 1.0e-5
         assert (abs(covariance[1, 1] - sampler.covariance[1, 1])) <= 1.0e-5
 
+    def test_candidate_buffers_reused(self):
+        """Check the proposal block and state buffers are not reallocated."""
+        constraints = hs.MockedConstraints()
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        x = distribution.get_example()
+        cov = np.identity(2)
+        sampler = sr.MetroSampler(distribution, x, cov, 50, 0, 0)
+
+        candidates = sampler.candidates
+        buffers = set([id(sampler.x_last), id(sampler.x_candidate)])
+        sampler.sample(120, 1)
+
+        assert sampler.candidates is candidates
+        assert sampler.cursor == 20
+        assert set([id(sampler.x_last), id(sampler.x_candidate)]) == buffers
+        assert x[0] == .2 and x[1] == .5
+
+    def test_log_space_acceptance(self):
+        """Check the chain moves when the density underflows to zero."""
+        distribution = hs.MockedGaussian(100)
+
+        x = distribution.get_example()
+        assert distribution.prob(x) == 0.0
+
+        cov = 0.01 * np.identity(100)
+        sampler = sr.MetroSampler(distribution, x, cov, 200, 1000, 0)
+        _, accepted, _ = sampler.sample(100, 10)
+
+        assert accepted > 0
+        assert np.dot(sampler.x_last, sampler.x_last) < np.dot(x, x)
+
+    def test_iter_samples(self):
+        """Check blocks of samples match the samples of a single call."""
+        constraints = hs.MockedConstraints()
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        x = distribution.get_example()
+        cov = 0.1 * np.identity(2)
+
+        np.random.seed(7)
+        sampler = sr.MetroSampler(distribution, x, cov, 20, 50, 100)
+        samples, accepted, total = sampler.sample(10, 3)
+
+        np.random.seed(7)
+        sampler = sr.MetroSampler(distribution, x, cov, 20, 50, 100)
+        chunks = list(sampler.iter_samples(10, 3, 4))
+
+        assert [chunk.shape[0] for chunk in chunks] == [4, 4, 2]
+        assert sampler.sample(-1, 3)[0].shape[0] == 0
+        assert np.array_equal(np.concatenate(chunks), samples)
+        assert sampler.jumps_accepted == accepted
+        assert sampler.jumps_total == total
+
+    def test_checkpoint(self, tmpdir):
+        """Check a restored sampler continues the chain exactly."""
+        constraints = hs.MockedConstraints()
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        x = distribution.get_example()
+        cov = 0.1 * np.identity(2)
+        sampler = sr.MetroSampler(distribution, x, cov, 20, 50, 130)
+
+        fname = str(tmpdir.join('checkpoint.npz'))
+        sampler.save_checkpoint(fname, samples_done=3)
+        expected, accepted, _ = sampler.sample(50, 3)
+
+        restored = sr.MetroSampler.from_checkpoint(distribution, fname)
+        samples, restored_accepted, _ = restored.sample(50, 3)
+
+        assert np.array_equal(samples, expected)
+        assert restored_accepted == accepted
+        assert np.array_equal(restored.x_covariance, sampler.x_covariance)
+        assert restored.niter == sampler.niter
+
+        state = restored.load_checkpoint(fname)
+        assert int(state['samples_done']) == 3
+
+    def test_low_rank_updates(self, tmpdir):
+        """Check the low-rank updates follow the full adaptation."""
+        distribution = hs.MockedGaussian(5)
+        x = np.zeros(5)
+        cov = np.identity(5)
+
+        samplers = []
+        for low_rank_updates in [False, True]:
+            np.random.seed(0)
+            samplers.append(sr.MetroSampler(
+                distribution, x, cov, 20, 100, 1000, 1.0,
+                low_rank_updates=low_rank_updates))
+        full, low_rank = samplers
+
+        # The chains differ only through the regularization of the proposal
+        assert np.allclose(low_rank.x_covariance, full.x_covariance,
+                           atol=1.0e-5)
+        assert np.allclose(low_rank.covariance, full.covariance, atol=1.0e-5)
+        assert np.allclose(np.dot(low_rank.factor, low_rank.factor.T),
+                           low_rank.covariance)
+        assert np.allclose(low_rank.x_last, full.x_last, atol=1.0e-5)
+        assert 0.5 * low_rank.eps <= low_rank.eps_factor <= low_rank.eps
+
+        # Collected differences survive a checkpoint in the middle of a block
+        low_rank.sample(1, 7)
+        fname = str(tmpdir.join('checkpoint.npz'))
+        low_rank.save_checkpoint(fname)
+        expected, _, _ = low_rank.sample(10, 7)
+
+        restored = sr.MetroSampler.from_checkpoint(distribution, fname)
+        samples, _, _ = restored.sample(10, 7)
+        assert np.array_equal(samples, expected)
+        assert np.array_equal(restored.factor, low_rank.factor)
+
+    def test_set_gamma(self):
+        """Check the proposal is rescaled without losing the learnt moments."""
+        constraints = hs.MockedConstraints()
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        x = distribution.get_example()
+        cov = 0.1 * np.identity(2)
+        sampler = sr.MetroSampler(distribution, x, cov, 20, 50, 100, 1.0)
+
+        x_covariance = sampler.x_covariance.copy()
+        covariance = sampler.covariance.copy()
+        sampler.set_gamma(0.5)
+
+        assert np.array_equal(sampler.x_covariance, x_covariance)
+        assert np.allclose(sampler.covariance, 0.5 * covariance)
+        assert sampler.cursor == sampler.candidates.shape[0]
+
+    def test_set_state(self):
+        """Check the chain moves to a new state keeping its moments."""
+        distribution = hs.MockedGaussian(2)
+        sampler = sr.MetroSampler(distribution, np.zeros(2), np.identity(2),
+                                  20, 50, 100, 1.0)
+
+        x_covariance = sampler.x_covariance.copy()
+        sampler.set_state(np.array([1.0, 2.0]))
+        assert np.array_equal(sampler.x_last, [1.0, 2.0])
+        assert sampler.x_last_log_prob == -2.5
+        assert np.array_equal(sampler.x_covariance, x_covariance)
+
+        sampler.set_state(np.array([0.0, 1.0]), -7.0)
+        assert sampler.x_last_log_prob == -7.0
+
+    def test_delayed_rejection(self):
+        """Check the second candidates keep the target and raise acceptance."""
+        distribution = hs.MockedGaussian(2)
+        ratios = []
+        for dr_scale in [None, 0.1]:
+            np.random.seed(0)
+            sampler = sr.MetroSampler(distribution, np.zeros(2),
+                                      25.0 * np.identity(2), 200, 10 ** 9,
+                                      1000, 1.0, dr_scale=dr_scale)
+            samples, accepted, total = sampler.sample(5000, 4)
+            ratios.append(float(accepted) / float(total))
+
+            assert np.all(np.abs(np.mean(samples, 0)) < 0.1)
+            assert np.all(np.abs(np.var(samples, 0) - 1.0) < 0.1)
+
+        assert sampler.dr_total > 0 and sampler.dr_accepted > 0
+        assert ratios[1] > 5.0 * ratios[0]
+
+    def test_speculation(self):
+        """Check speculative evaluation gives the serial chain."""
+        distribution = hs.MockedGaussian(3)
+        for dr_scale in [None, 0.2]:
+            chains = []
+            for speculate in [0, 4]:
+                np.random.seed(3)
+                sampler = sr.MetroSampler(distribution, np.zeros(3),
+                                          4.0 * np.identity(3), 50, 100, 200,
+                                          dr_scale=dr_scale,
+                                          speculate=speculate)
+                chains.append(sampler.sample(100, 5))
+                sampler.close()
+
+            assert np.array_equal(chains[0][0], chains[1][0])
+            assert chains[0][1:] == chains[1][1:]
+
+    def test_speculation_with_constraints(self, tmpdir):
+        """Check the constraint statistics stay consistent on threads."""
+        fname = tmpdir.join('circle.txt')
+        fname.write('2\n0.3 0.3\n'
+                    'x[0] * x[0] + x[1] * x[1] <= 0.6\n'
+                    'x[0] * x[1] <= 0.2\n')
+        chains = []
+        for speculate in [0, 4]:
+            constraints = cs.Constraint(str(fname), reorder_every=7)
+            constraints.track_rejections()
+            distribution = pr.ConstrainedDistribution(constraints)
+            sampler = sr.MetroSampler(distribution, np.array([.3, .3]),
+                                      np.identity(2), 20, 100, 100,
+                                      random_state=4, speculate=speculate)
+            chains.append(sampler.sample(50, 5)[0])
+            sampler.close()
+
+            assert constraints.stops.sum() == constraints.evaluations
+            assert sorted(constraints.get_order()) == [0, 1]
+
+        assert np.array_equal(chains[0], chains[1])
+
+    def test_random_state(self, tmpdir):
+        """Check chains with their own generators are reproducible."""
+        distribution = hs.MockedGaussian(2)
+        x, cov = np.zeros(2), np.identity(2)
+
+        # Chains advanced in turn do not share their random numbers
+        first = sr.MetroSampler(distribution, x, cov, 20, 50, 100,
+                                random_state=5)
+        other = sr.MetroSampler(distribution, x, cov, 20, 50, 100,
+                                random_state=6)
+        samples, _, _ = first.sample(20, 3)
+        other.sample(20, 3)
+        replay = sr.MetroSampler(distribution, x, cov, 20, 50, 100,
+                                 random_state=np.random.RandomState(5))
+        assert np.array_equal(replay.sample(20, 3)[0], samples)
+        assert not np.array_equal(other.x_last, first.x_last)
+
+        # The checkpoint restores the generator of the sampler
+        fname = str(tmpdir.join('checkpoint.npz'))
+        first.save_checkpoint(fname)
+        expected, _, _ = first.sample(20, 3)
+        restored = sr.MetroSampler.from_checkpoint(
+            distribution, fname, np.random.RandomState())
+        assert np.array_equal(restored.sample(20, 3)[0], expected)
+
+        seeds = sr.spawn_seeds(7, 3)
+        assert np.array_equal(seeds, sr.spawn_seeds(7, 3))
+        assert len(set(seeds)) == 3
+
+    def test_structured_covariance(self, tmpdir):
+        """Check diagonal and block moments match the dense ones."""
+        distribution = hs.MockedGaussian(4)
+        x, cov = np.zeros(4), np.identity(4)
+
+        # With the initial proposal all chains are the same
+        samplers = []
+        for structure in [None, 'diagonal', [[0, 2], [1], [3]]]:
+            samplers.append(sr.MetroSampler(distribution, x, cov, 20, 10 ** 9,
+                                            500, random_state=2,
+                                            structure=structure))
+        dense, diagonal, blocks = samplers
+
+        assert np.array_equal(diagonal.x_last, dense.x_last)
+        assert np.allclose(diagonal.x_covariance, np.diag(dense.x_covariance))
+        assert np.allclose(blocks.x_covariance[0],
+                           dense.x_covariance[np.ix_([0, 2], [0, 2])])
+        assert np.allclose(blocks.x_covariance[2], dense.x_covariance[3, 3])
+
+        # The learnt proposal keeps the structure through a checkpoint
+        blocks.t0 = 0
+        blocks.set_gamma(1.0)
+        assert blocks.covariance[0].shape == (2, 2)
+        assert np.allclose(np.dot(blocks.factor[0], blocks.factor[0].T),
+                           blocks.covariance[0])
+        fname = str(tmpdir.join('checkpoint.npz'))
+        blocks.save_checkpoint(fname)
+        expected, _, _ = blocks.sample(10, 5)
+
+        restored = sr.MetroSampler.from_checkpoint(
+            distribution, fname, np.random.RandomState())
+        assert np.array_equal(restored.sample(10, 5)[0], expected)
+        assert restored.structure == 'blocks'
+        assert [list(block) for block in restored.blocks] == [[0, 2], [1], [3]]
+
+        with pytest.raises(ValueError):
+            sr.MetroSampler(distribution, x, cov, structure=[[0, 1], [1, 3]])
+        with pytest.raises(ValueError):
+            sr.MetroSampler(distribution, x, cov, structure='diagonal',
+                            low_rank_updates=True)
+
+    def test_profile_and_callback(self):
+        """Check the profile and the step callback see every step."""
+        constraints = hs.MockedConstraints()
+        distribution = pr.ConstrainedDistribution(constraints)
+
+        x = distribution.get_example()
+        cov = 0.1 * np.identity(2)
+        sampler = sr.MetroSampler(distribution, x, cov, 20, 50, 0)
+
+        calls = []
+        sampler.profile = pf.SamplerProfile(window=30)
+        sampler.step_callback = lambda chain, accepted: calls.append(accepted)
+        _, accepted, total = sampler.sample(100, 3)
+
+        assert sampler.profile.steps == total
+        assert sampler.profile.accepted == accepted
+        assert len(sampler.profile.acceptance_trace) == 10
+        assert len(calls) == total and sum(calls) == accepted
+        assert sampler.profile.timings['adaptation'] > 0.0
+        assert 'bound by' in sampler.profile.report()
+
+    def test_sample_until_ess(self):
+        """Check sampling stops once the requested ESS is reached."""
+        distribution = hs.MockedGaussian(2)
+
+        x = np.zeros(2)
+        cov = 0.1 * np.identity(2)
+        sampler = sr.MetroSampler(distribution, x, cov, 200, 1000, 2000, 0.5)
+        samples, accepted, total = sampler.sample_until_ess(200, 100, 500)
+
+        tau = np.max(sampler.autocorrelation.integrated_time())
+        assert tau > 1.0
+        assert total < 10000000
+        assert sampler.autocorrelation.nlen == total
+        assert 150 <= samples.shape[0] <= 250
@@ -0,0 +1,67 @@
+import pytest
+import numpy as np
+import metrosampler.sampler as sr
+import metrosampler.posterior as pr
+import metrosampler.tempering as tp
+
+
+class Bimodal(pr.Distribution):
+    """Mixture of two narrow Gaussians centered at -4 and 4."""
+
+    def __init__(self):
+        self.ndim = 1
+
+    def get_example(self):
+        return np.array([-4.0])
+
+    def prob(self, x):
+        return np.exp(self.log_prob(x))
+
+    def log_prob(self, x):
+        return np.logaddexp(-2.0 * (x[0] - 4.0) ** 2,
+                            -2.0 * (x[0] + 4.0) ** 2)
+
+
+class TestTempering(object):
+
+    def test_tempered_distribution(self):
+        """Verify that the tempered density is the density to the beta."""
+        distribution = tp.TemperedDistribution(Bimodal(), 0.25)
+        x = np.array([[0.0], [1.0], [-4.0]])
+
+        expected = 0.25 * np.array([Bimodal().log_prob(val) for val in x])
+        assert np.allclose(distribution.log_prob_batch(x), expected)
+        assert np.allclose([distribution.log_prob(val) for val in x],
+                           expected)
+        assert np.allclose(tp.geometric_betas(3, 100.0), [1.0, 0.1, 0.01])
+
+    def test_invalid_betas(self):
+        """Verify that the ladder must decrease from 1."""
+        with pytest.raises(ValueError):
+            tp.ReplicaExchangeSampler(Bimodal(), np.array([-4.0]),
+                                      np.identity(1), betas=[0.5, 0.1])
+        with pytest.raises(ValueError):
+            tp.ReplicaExchangeSampler(Bimodal(), np.array([-4.0]),
+                                      np.identity(1), betas=[1.0, 1.0])
+
+    def test_both_modes_are_visited(self):
+        """Verify that replica exchange mixes between the two modes."""
+        np.random.seed(0)
+        single = sr.MetroSampler(Bimodal(), np.array([-4.0]), np.identity(1),
+                                 tb=1000)
+        samples, _, _ = single.sample(500, 10)
+        assert np.all(samples < 0.0)
+
+        for workers in [1, 2]:
+            exchange = tp.ReplicaExchangeSampler(
+                Bimodal(), np.array([-4.0]), np.identity(1),
+                betas=tp.geometric_betas(4, 50.0), swap_every=10,
+                workers=workers, seed=1, tb=1000)
+            try:
+                samples, accepted, total = exchange.sample(500, 10)
+            finally:
+                exchange.close()
+
+            assert total == 5000 and 0 < accepted < total
+            assert np.all(exchange.swaps_accepted > 0)
+            assert abs(np.mean(samples > 0.0) - 0.5) < 0.2
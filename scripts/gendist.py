@@ -1,7 +1,15 @@
 import os
+import sys
+import time
 import argparse
+import multiprocessing
 import numpy as np
+import metrosampler.output as out
 import metrosampler.sampler as samp
+import metrosampler.ensemble as ens
+import metrosampler.parallel as para
+import metrosampler.profiling as prof
+import metrosampler.hitandrun as hitr
 import metrosampler.posterior as post
 import metrosampler.constraints as cons
 
@@ -37,6 +45,234 @@ def adjust_gamma(ratio, gamma):
     return gamma    
 
 
+def select_gamma(gammas, ratios):
+    """
+    Select the step size scaling whose ratio of accepted / total jumps is
+    closest to the acceptable window used by adjust_gamma.
+
+    Ties between values inside the window are broken in favour of the ratio
+    closest to the middle of the window.
+
+    :return: the index of the selected value
+    """
+    distance = np.maximum(0.20 - ratios, 0.0) + np.maximum(ratios - 0.35, 0.0)
+    centered = np.abs(ratios - 0.275)
+    return int(np.lexsort((centered, distance))[0])
+
+
+def tune_gamma(sampler, gamma=.1):
+    """
+    Tune the step size scaling of a running sampler.
+
+    The chain keeps its state and learnt covariance from one trial value of
+    gamma to the next, so that it can be used for sampling right after the
+    tuning, without a new burnin. At most 8 trials are run. The jumps of
+    all chains count for samplers running several chains.
+    """
+    ratio = .0
+    steps = 0
+
+    print "Adjusting the step size...\n"
+    while steps < 8 and (ratio < .20 or ratio > .35):
+         sampler.set_gamma(gamma)
+         vals, accepted, total = sampler.sample(2000, 10)
+         accepted, total = np.sum(accepted), np.sum(total)
+         print 'With gamma = %f, the number of accepted and total ' \
+               'samples is %d %d' % (gamma, accepted, total) 
+         ratio = float(accepted) / float(total) 
+         gamma = adjust_gamma(ratio, gamma)
+         steps += 1
+
+    # Only jumps made with the final step size count towards the results
+    sampler.set_gamma(gamma)
+    sampler.jumps_accepted = 0
+    sampler.jumps_total = 0
+    return gamma
+
+
+def search_gamma(posterior, x0, cov0, t0, tb, trials, workers, **kwargs):
+    """
+    Try a geometric grid of step size scalings in parallel and return the
+    chain of the best one, ready to be used for sampling. If the acceptance
+    ratio of the best value is outside the acceptable window, the value is
+    refined on its chain with tune_gamma. Additional arguments are passed to
+    MetroSampler.
+    """
+    gammas = np.logspace(-4, 1, trials)
+
+    print "Adjusting the step size with %d parallel trials...\n" % trials
+    ratios, chains = para.evaluate_gammas(posterior, x0, cov0, gammas, 2000,
+                                          10, workers, update_freq=200, t0=t0,
+                                          tb=tb, **kwargs)
+    for gamma, ratio in zip(gammas, ratios):
+        print 'With gamma = %f, the ratio of accepted and total ' \
+              'samples is %f' % (gamma, ratio)
+
+    best = select_gamma(gammas, ratios)
+    sampler, gamma = chains[best], gammas[best]
+    if ratios[best] <= .20 or ratios[best] >= .35:
+        print '\nThe best ratio is outside the acceptable window, refining'
+        return sampler, tune_gamma(sampler,
+                                   adjust_gamma(ratios[best], gamma))
+
+    sampler.jumps_accepted = 0
+    sampler.jumps_total = 0
+    return sampler, gamma
+
+
+def write_samples(sampler, samples_number, writer, chunk_size,
+                  checkpoint=None, samples_done=0, **extra):
+    """
+    Generate samples in blocks and write every block as soon as it is ready.
+
+    With a checkpoint file, the sampler is checkpointed after every block
+    together with the number of samples written so far, which is also the
+    position of the writer, so that an interrupted run resumes after the
+    last block written; extra values are stored with every checkpoint.
+    """
+    if checkpoint is not None:
+        sampler.save_checkpoint(checkpoint, samples_done=samples_done,
+                                output_size=writer.position(), **extra)
+
+    for chunk in sampler.iter_samples(samples_number - samples_done, 200,
+                                      chunk_size):
+        writer.write(sampler.posterior.to_original(chunk))
+        samples_done += chunk.shape[0]
+        if checkpoint is not None:
+            writer.flush()
+            sampler.save_checkpoint(checkpoint, samples_done=samples_done,
+                                    output_size=writer.position(), **extra)
+
+    return sampler.jumps_accepted, sampler.jumps_total
+
+
+def store_samples(args, posterior, vals, **metadata):
+    """
+    Write samples held in memory to the output file in the requested format.
+    """
+    dtype = np.float32 if args.float32 else np.float64
+    writer = out.open_writer(args.outfile, args.format, posterior.ndim,
+                             vals.shape[0], dtype)
+    writer.write(posterior.to_original(vals))
+    writer.close()
+    save_metadata(args, posterior, vals.shape[0], **metadata)
+
+
+def save_metadata(args, posterior, samples_number, accepted, total,
+                  gamma=None):
+    """Save the description of the run next to the output file."""
+    accepted, total = int(np.sum(accepted)), int(np.sum(total))
+    out.save_metadata(args.outfile, inpfile=args.inpfile,
+                      method=args.method, ndim=posterior.ndim,
+                      samples=samples_number, format=args.format,
+                      dtype='float32' if args.float32 else 'float64',
+                      gamma=None if gamma is None else float(gamma),
+                      accepted=accepted, total=total,
+                      acceptance=float(accepted) / total if total else 0.0,
+                      seed=args.seed)
+
+
+def list_inputs(path):
+    """
+    Return the constraint files of a directory, sorted by name, or the files
+    listed in a manifest, one per line. Paths in a manifest are relative to
+    the directory of the manifest; empty lines and comments are skipped.
+    """
+    if os.path.isdir(path):
+        names = sorted(name for name in os.listdir(path) if name[0] != '.')
+        return [os.path.join(path, name) for name in names
+                if os.path.isfile(os.path.join(path, name))]
+
+    with open(path, 'r') as f:
+        lines = [line.strip() for line in f.readlines()]
+    return [os.path.join(os.path.dirname(path), line) for line in lines
+            if line and line[0] != '#']
+
+
+def _sample_file_task(args):
+    """
+    Generate the samples of one file of a batch in a worker process.
+
+    The messages of the run are written to a log file next to the output;
+    errors are reported in the summary instead of stopping the batch.
+    """
+    start = time.time()
+
+    accepted, total, status = 0, 0, 'ok'
+    stdout = sys.stdout
+    try:
+        with open(os.path.splitext(args.outfile)[0] + '.log', 'w') as log:
+            sys.stdout = log
+            accepted, total = sample_file(args)
+    except Exception as err:
+        status = 'error: %s' % err
+    finally:
+        sys.stdout = stdout
+    return args.inpfile, accepted, total, time.time() - start, status
+
+
+def sample_batch(args):
+    """
+    Generate samples for every constraint file of a directory or manifest.
+
+    The files are shared among a pool of worker processes, each of which
+    runs one file after the other; every file is sampled on one process,
+    with the options of the command line, and its samples are written to
+    the output directory under the name of the file. A table with the
+    timing and acceptance of every file is printed and saved to
+    summary.txt in the output directory.
+    """
+    inputs = list_inputs(args.inpfile)
+    if not os.path.isdir(args.outfile):
+        os.makedirs(args.outfile)
+    if args.checkpoint is not None or args.profile is not None:
+        print 'Checkpoints and profiles are not supported in batch mode, ' \
+              'ignoring'
+
+    # Every file gets its own seed and the options of the command line
+    seeds = np.random.RandomState(args.seed).randint(0, 2 ** 31 - 1,
+                                                     len(inputs))
+    tasks = []
+    for inpfile, seed in zip(inputs, seeds):
+        name = os.path.splitext(os.path.basename(inpfile))[0]
+        options = argparse.Namespace(**vars(args))
+        options.inpfile = inpfile
+        options.outfile = os.path.join(args.outfile,
+                                       name + '.' + args.format)
+        options.seed = int(seed)
+        options.workers = 1
+        options.checkpoint = None
+        options.profile = None
+        tasks.append(options)
+
+    workers = args.workers if args.workers is not None else \
+        multiprocessing.cpu_count()
+    print 'Sampling %d files with %d workers...\n' % (len(tasks), workers)
+
+    results = []
+    pool = multiprocessing.Pool(max(workers, 1))
+    try:
+        for result in pool.imap(_sample_file_task, tasks):
+            print '%s: %s' % (result[0], result[4])
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    lines = ['%-40s %10s %10s %8s %10s  %s' % ('file', 'accepted', 'total',
+                                                'ratio', 'time (s)', 'status')]
+    for inpfile, accepted, total, elapsed, status in results:
+        ratio = float(accepted) / float(total) if total else 0.0
+        lines.append('%-40s %10d %10d %8.4f %10.2f  %s' %
+                     (os.path.basename(inpfile), accepted, total, ratio,
+                      elapsed, status))
+    summary = '\n'.join(lines) + '\n'
+
+    print '\n' + summary
+    with open(os.path.join(args.outfile, 'summary.txt'), 'w') as f:
+        f.write(summary)
+
+
 def gendist():
 
     # Arguments descriptions
@@ -44,14 +280,81 @@ def gendist():
     descI = 'path to file with constraints specification'
     descO = 'path to file where sample will be saved'
     descS = 'number of samples to generate'
+    descC = 'number of independent chains used for sampling, or size of ' \
+            'the ensemble; defaults to 1, and to 8 for the ensemble method'
+    descW = 'number of worker processes running the chains'
+    descK = 'path to checkpoint file used to save and resume the sampler'
+    descE = 'number of samples generated between checkpoints'
+    descT = 'tune the step size serially on one chain or in parallel'
+    descG = 'number of step sizes tried by the parallel tuning'
+    descP = 'path to file where a profile of the sampling will be written'
+    descM = 'sampling method; hit-and-run requires linear constraints, ' \
+            'the ensemble runs the chains in lock-step in one process'
+    descN = 'target effective sample size; the number of samples and the ' \
+            'sampling frequency are then set from the autocorrelation time'
+    descJ = 'largest lag of the autocorrelation tracked for a target ESS; ' \
+            'every step costs time in proportion to it'
+    descD = 'scaling of the second candidate tried after a rejection ' \
+            '(delayed rejection); disabled by default'
+    descL = 'update the factor of the proposal covariance with low-rank ' \
+            'updates, for high-dimensional constraints'
+    descB = 'sample every constraint file of the directory or manifest ' \
+            'given as input, writing the samples to the directory given as ' \
+            'output; the files are shared among the worker processes'
+    descH = 'directory where the analyzed constraints are cached between runs'
+    descF = 'format of the output file; npy files are written while the ' \
+            'chain runs and can be memory-mapped'
+    descX = 'store the samples as single precision, for binary formats'
+    descZ = 'seed of the random number generator'
+    descV = 'structure of the learnt covariance; a diagonal covariance ' \
+            'scales to high-dimensional constraints'
+    descR = 'sample in the bounding box of the constraints rescaled to the ' \
+            'unit hypercube'
 
     # Initialize parser and parse arguments
     parser = argparse.ArgumentParser(description=descA)
     parser.add_argument('inpfile', help=descI)
     parser.add_argument('outfile', help=descO)
     parser.add_argument('samples', help=descS, type=int)
+    parser.add_argument('--chains', help=descC, type=int, default=None)
+    parser.add_argument('--workers', help=descW, type=int, default=None)
+    parser.add_argument('--checkpoint', help=descK, default=None)
+    parser.add_argument('--checkpoint-every', help=descE, type=int,
+                        default=1000)
+    parser.add_argument('--tune', help=descT, default='serial',
+                        choices=['serial', 'parallel'])
+    parser.add_argument('--tune-grid', help=descG, type=int, default=8)
+    parser.add_argument('--profile', help=descP, default=None)
+    parser.add_argument('--ess', help=descN, type=int, default=None)
+    parser.add_argument('--max-lag', help=descJ, type=int, default=200)
+    parser.add_argument('--method', help=descM, default='metropolis',
+                        choices=['metropolis', 'hitandrun', 'ensemble'])
+    parser.add_argument('--rescale', help=descR, action='store_true')
+    parser.add_argument('--dr-scale', help=descD, type=float, default=None)
+    parser.add_argument('--low-rank', help=descL, action='store_true')
+    parser.add_argument('--batch', help=descB, action='store_true')
+    parser.add_argument('--cache-dir', help=descH, default=None)
+    parser.add_argument('--format', help=descF, default='txt',
+                        choices=list(out.FORMATS))
+    parser.add_argument('--float32', help=descX, action='store_true')
+    parser.add_argument('--seed', help=descZ, type=int, default=None)
+    parser.add_argument('--covariance', help=descV, default='dense',
+                        choices=['dense', 'diagonal'])
     args = parser.parse_args()
 
+    # An ensemble of one chain gains nothing from the lock-step steps
+    if args.chains is None:
+        args.chains = 8 if args.method == 'ensemble' else 1
+    elif args.method == 'ensemble' and args.chains < 2:
+        parser.error('the ensemble method needs at least 2 chains')
+
+    if args.batch:
+        if not os.path.exists(args.inpfile):
+            print 'Error: the specified input does not exist !!!'
+            exit(0)
+        sample_batch(args)
+        return
+
     # Check that constraints file exists
     input_file = args.inpfile
     if not os.path.isfile(input_file):
@@ -60,45 +363,162 @@ def gendist():
 
     # Check that output file can be written
     try:
-       with open(args.outfile, 'w') as f:
+       with open(args.outfile, 'a') as f:
            pass
     except IOError as err:
        print 'Cannot write to output file: ', err.errno, ',', err.strerror
        exit(0)
 
+    sample_file(args)
+
+
+def sample_file(args):
+    """
+    Generate samples for a constraints file with the options of the command
+    line and write them to the output file, with a JSON file describing the
+    run next to it.
+
+    :return: the numbers of accepted and total jumps
+    """
+    # Checkpoints and profiles are only supported for single chain runs
+    if args.checkpoint is not None and args.chains > 1:
+        print 'Checkpoints are not supported with multiple chains, ignoring'
+        args.checkpoint = None
+    if args.profile is not None and args.chains > 1:
+        print 'Profiles are not supported with multiple chains, ignoring'
+        args.profile = None
+    if args.ess is not None and (args.chains > 1 or args.checkpoint):
+        print 'A target ESS is only supported for single chain runs ' \
+              'without checkpoints, ignoring'
+        args.ess = None
+    if args.float32 and args.format == 'txt':
+        print 'Single precision only applies to binary formats, ignoring'
+        args.float32 = False
+    if args.low_rank and args.covariance != 'dense':
+        print 'Low-rank updates require a dense covariance, ignoring'
+        args.low_rank = False
+
+    if args.seed is not None:
+        np.random.seed(args.seed)
+
     # Create constrained distribution
-    constraints = cons.Constraint(input_file)
-    posterior = post.ConstrainedDistribution(constraints)
+    constraints = cons.Constraint(args.inpfile, cache_dir=args.cache_dir)
+    posterior = post.ConstrainedDistribution(constraints, args.rescale)
 
-    # Initial state of Markov chain and initial covariance matrix
+    # Initial state of Markov chain and initial covariance matrix, or its
+    # variances for a diagonal covariance
     x0 = posterior.get_example()
-    cov0 = np.identity(x0.shape[0])
+    if args.method == 'metropolis' and args.covariance == 'diagonal':
+        cov0 = np.ones(x0.shape[0])
+    else:
+        cov0 = np.identity(x0.shape[0])
 
     # Initialize sampler parameters
     t0 = 1000 
     tb = 10000
-    ratio = .0
-    gamma = .1
-    steps = 0
 
-    # Tune the sampler step size
-    print "Adjusting the step size...\n"
-    while steps < 8 and (ratio < .20 or ratio > .35):
-         sampler = samp.MetroSampler(posterior, x0, cov0, 200, t0, tb, gamma)
-         vals, accepted, total = sampler.sample(2000, 10)
-         print 'With gamma = %f, the number of accepted and total ' \
-               'samples is %d %d' % (gamma, accepted, total) 
-         ratio = float(accepted) / float(total) 
-         gamma = adjust_gamma(ratio, gamma)
-         steps += 1
+    # Hit-and-run accepts every step and needs no tuning
+    if args.method == 'hitandrun':
+        print 'Sampling with hit-and-run, other sampling options are ignored'
+        sampler = hitr.HitAndRunSampler(posterior, x0, tb)
+        vals, accepted, total = sampler.sample(args.samples, 200)
+        print 'Sampling completed. Storing data to file..'
+        store_samples(args, posterior, vals, accepted=accepted, total=total)
+        return accepted, total
+
+    # The ensemble is tuned and sampled as a whole
+    if args.method == 'ensemble':
+        print 'Sampling with an ensemble of %d chains, checkpoint, profile ' \
+              'and ESS options are ignored' % args.chains
+        sampler = ens.EnsembleSampler(posterior, x0, cov0, args.chains, 200,
+                                      t0, tb, .1)
+        gamma = tune_gamma(sampler, .1)
+        print '\nThe optimal step size is gamma = %f' % gamma
+        vals, accepted, total = sampler.sample(args.samples, 200)
+        accepted, total = accepted.sum(), total.sum()
+        print 'Sampling completed. The number of accepted and total ' \
+              'samples is: %d %d' % (accepted, total), \
+              '. Storing data to file..'
+        store_samples(args, posterior, vals, accepted=accepted, total=total,
+                      gamma=gamma)
+        return accepted, total
+
+    # Resume from the checkpoint or tune the step size of a new sampler
+    options = dict(dr_scale=args.dr_scale, low_rank_updates=args.low_rank,
+                   structure=args.covariance)
+    state = None
+    if args.checkpoint is not None and os.path.isfile(args.checkpoint):
+        sampler = samp.MetroSampler(posterior, x0, cov0, 200, t0, 0,
+                                    structure=args.covariance)
+        state = sampler.load_checkpoint(args.checkpoint)
+        gamma = float(state['gamma'])
+        print 'Resuming from checkpoint %s with gamma = %f' % \
+              (args.checkpoint, gamma)
+    elif args.tune == 'parallel':
+        sampler, gamma = search_gamma(posterior, x0, cov0, t0, tb,
+                                      args.tune_grid, args.workers,
+                                      **options)
+    else:
+        sampler = samp.MetroSampler(posterior, x0, cov0, 200, t0, tb, .1,
+                                    **options)
+        gamma = tune_gamma(sampler, .1)
 
     # Start sampling
     print '\nThe optimal step size is gamma = %f' % gamma, '. Start sampling...'
-    sampler = samp.MetroSampler(posterior, x0, cov0, 200, t0, tb*5, gamma) 
-    vals, accepted, total = sampler.sample(args.samples, 200)
+    if args.chains > 1:
+        # Chains start from the state and proposal of the tuned chain
+        vals, accepted, total = para.sample_chains(
+            posterior, sampler.x_last, sampler.covariance, args.samples, 200,
+            args.chains, args.workers, update_freq=200, t0=t0, tb=tb,
+            gamma=gamma, **options)
+        for i in range(args.chains):
+            print 'Chain %d: the number of accepted and total samples is ' \
+                  '%d %d' % (i, accepted[i], total[i])
+        accepted, total = accepted.sum(), total.sum()
+        print 'Sampling completed. The number of accepted and total ' \
+              'samples is: %d %d' % (accepted, total), \
+              '. Storing data to file..'
+        store_samples(args, posterior, vals, accepted=accepted, total=total,
+                      gamma=gamma)
+        return accepted, total
 
-    # Store samples to file
-    print 'Sampling completed. The number of accepted and total ' \
-          'samples is: %d %d' % (accepted, total), '. Storing data to file..'
-    np.savetxt(args.outfile, vals, delimiter=' ', fmt='%1.4e')
+    if args.profile is not None:
+        sampler.profile = prof.SamplerProfile()
+        constraints.track_rejections()
+
+    if args.ess is not None:
+        vals, accepted, total = sampler.sample_until_ess(args.ess,
+                                                         args.max_lag)
+        tau = np.max(sampler.autocorrelation.integrated_time())
+        print 'The autocorrelation time is %f, %d samples were kept' % \
+              (tau, vals.shape[0])
+        store_samples(args, posterior, vals, accepted=accepted, total=total,
+                      gamma=gamma)
+    else:
+        # Samples are written while the chain runs, after the samples kept
+        # from the checkpointed run writing to the same output
+        position = 0
+        if state and str(state['outfile']) == args.outfile:
+            position = int(state['output_size'])
+
+        dtype = np.float32 if args.float32 else np.float64
+        writer = out.open_writer(args.outfile, args.format, posterior.ndim,
+                                 args.samples, dtype, position)
+        samples_done = writer.position()
+        try:
+            accepted, total = write_samples(
+                sampler, args.samples, writer,
+                args.checkpoint_every if args.checkpoint else 1000,
+                args.checkpoint, samples_done, outfile=args.outfile,
+                gamma=gamma)
+        finally:
+            writer.close()
+        save_metadata(args, posterior, args.samples, accepted, total, gamma)
 
+    if args.profile is not None:
+        with open(args.profile, 'w') as f:
+            f.write(sampler.profile.report(constraints))
+
+    print 'Sampling completed. The number of accepted and total ' \
+          'samples is: %d %d' % (accepted, total)
+    return accepted, total
@@ -8,7 +8,7 @@ setup(name='metrosampler',
       author='Giulio Borghesi',
       author_email='giulio.borghesi.1981@gmail.com',
       license='MIT',
-      packages=find_packages(),
+      packages=find_packages(exclude=['benchmarks']),
       install_requires=['numpy', 'scipy', 'matplotlib <= 2.2.3', 'pytest'],
       entry_points = {
           'console_scripts': [